@@ -0,0 +1,423 @@
+import io
+import sys
+import json
+import time
+import random
+import argparse
+
+import shapely
+import numpy as np
+
+try:
+    import importlib.resources as pkg_resources
+except ImportError:
+    # Try backported to PY<37 `importlib_resources`.
+    import importlib_resources as pkg_resources
+
+from PIL import Image, ImageChops
+
+from truthsayer import assets
+from truthsayer.processor import Caretaker, OriginatorTruthsayer
+from truthsayer.renderer import Renderer
+from truthsayer.profiling import Profiler
+from truthsayer.geometry import circleOverlaps, circlePolygonOverlaps
+from truthsayer.solvers import PLACEMENT_SOLVERS
+from truthsayer.placements import PlacementCache
+from truthsayer.replay import exportReplay, historyStates, changedMask
+
+# slowdowns below this many seconds are too noisy to count as regressions,
+# renders of a few tens of milliseconds vary by half between runs
+NOISE_FLOOR = 0.05
+# closed form overlap areas may differ from finely buffered shapely ones by this fraction of the disc
+GEOMETRY_TOLERANCE = 1e-4
+
+meta = {
+    'factions': {},
+    'usernames': {},
+    'user_ids': {},
+    'user_discriminators': {},
+    'texts': {
+        'promo_top': 'Truthsayer Discord',
+        'promo': 'Join us for more Dune games!',
+        'game_id': '#21762',
+        'game_name': 'benchmark',
+        'game_turn': 6,
+        'game_phase': 'battle',
+        'qr': 'https://discord.gg/VVYM22Hs2t',
+        'commands': []
+    }
+}
+
+
+def newGame(players=6):
+    originator = OriginatorTruthsayer(meta=json.loads(json.dumps(meta)))
+    caretaker = Caretaker(originator, [], [])
+    for seat in range(1, players+1):
+        originator.join(seat, 'player{0}'.format(seat), '#{0:04d}'.format(seat), seat)
+        caretaker.backup()
+    return originator, caretaker
+
+
+def factions(originator):
+    return [originator._object_state['meta']['factions']['player_{0}'.format(seat)] for seat in range(1, 7)]
+
+
+def spiceTerritories(originator):
+    circles = originator.processor.game_config['generated']['territories']['circles']
+    return sorted([name[:-len('_spice')] for name in circles.keys() if name.endswith('_spice')])
+
+
+def landingSites(originator):
+    # territory and sector pairs troops can be shipped to
+    location_regions = originator.processor.game_config['generated']['location_regions']
+    sites = []
+    for territory in sorted(location_regions.keys()):
+        if territory in ['arrakis', 'polar_sink', 'tleilaxu_tanks']:
+            continue
+        for sector in sorted(location_regions[territory]):
+            sites.append((territory, sector))
+    return sites
+
+
+def scenarioEmpty():
+    originator = OriginatorTruthsayer(meta=json.loads(json.dumps(meta)))
+    return originator, Caretaker(originator, [], [])
+
+
+def scenarioOpening():
+    originator, caretaker = newGame()
+    originator.initgame()
+    caretaker.backup()
+    return originator, caretaker
+
+
+def scenarioCrowded():
+    originator, caretaker = scenarioOpening()
+    sites = landingSites(originator)
+    for faction in factions(originator):
+        for territory, sector in random.sample(sites, 3):
+            originator.ship(faction, territory, sector, 2)
+            caretaker.backup()
+    for territory in random.sample(spiceTerritories(originator), 4):
+        originator.spiceblow(territory, random.randint(2, 12))
+        caretaker.backup()
+    originator.storm('S7')
+    caretaker.backup()
+    return originator, caretaker
+
+
+def scenarioPacked():
+    # every faction lands in the same sectors, more tokens than there are slots
+    originator, caretaker = scenarioOpening()
+    for territory, sector in random.sample(landingSites(originator), 3):
+        for faction in factions(originator):
+            originator.ship(faction, territory, sector, 1)
+        caretaker.backup()
+    return originator, caretaker
+
+
+def scenarioBattle():
+    originator, caretaker = scenarioOpening()
+    attacker, defender = factions(originator)[:2]
+    for faction in [attacker, defender]:
+        originator.draw(faction, 'treachery', 2)
+        caretaker.backup()
+    originator.battle(attacker, defender)
+    caretaker.backup()
+    for faction, deployed in [(attacker, 4), (defender, 3)]:
+        hand = originator.hand(faction)
+        originator.deployment(faction, deployed)
+        originator.lead(faction, hand['leaders'][0][0])
+        for card_type, cards in hand['cards'].items():
+            originator.treachery(faction, card_type, cards[0])
+        caretaker.backup()
+    return originator, caretaker
+
+
+def scenarioReplay(commands=200):
+    originator, caretaker = scenarioOpening()
+    spice = spiceTerritories(originator)
+    for n in range(commands):
+        if n % 2 == 0:
+            originator.storm('S{0}'.format(n % 18 + 1))
+        else:
+            originator.spiceblow(spice[n % len(spice)], n % 10 + 1)
+        caretaker.backup()
+    return originator, caretaker
+
+
+SCENARIOS = {
+    'empty': scenarioEmpty,
+    'opening': scenarioOpening,
+    'crowded': scenarioCrowded,
+    'packed': scenarioPacked,
+    'battle': scenarioBattle,
+    'replay': scenarioReplay
+}
+
+
+def measureOnce(name, renders, seed=0, engine=None, budget=None):
+    random.seed(seed)
+    originator, caretaker = SCENARIOS[name]()
+    if engine is not None:
+        originator.processor.engine = engine
+    originator.processor.budget = budget
+    originator.processor.evaluations = 0
+    originator.processor.violation = 0.0
+    # placements solved by earlier scenarios are not reused
+    originator.processor.placements = PlacementCache()
+    battle = name == 'battle'
+    # processing places every token once, the placement solves are part of it
+    profiler = Profiler(memory=False)
+    originator.processor.profiler = profiler
+    start = time.perf_counter()
+    game_state = originator.processor.process(originator._object_state)
+    process_time = time.perf_counter()-start
+    originator.processor.profiler = Profiler(memory=False)
+    stages = {stage['stage']: stage for stage in profiler.report()['stages']}
+    placements = [stages[stage] for stage in ['placeSingleToken', 'placeMultipleTokens'] if stage in stages]
+    render_times = []
+    for _ in range(renders):
+        start = time.perf_counter()
+        renderer = Renderer(game_state, originator.processor.game_config, originator.cards_manager.card_objects, None, battle=battle)
+        renderer.render()
+        render_times.append(time.perf_counter()-start)
+    start = time.perf_counter()
+    caretaker.backup()
+    backup_time = time.perf_counter()-start
+    undos = len(caretaker._past)
+    start = time.perf_counter()
+    for _ in range(undos):
+        caretaker.undo()
+    undo_time = time.perf_counter()-start
+    return {
+        'process': process_time,
+        'placement': sum(stage['wall'] for stage in placements),
+        'placements': sum(stage['calls'] for stage in placements),
+        'evaluations': originator.processor.evaluations,
+        'violation': originator.processor.violation,
+        'render': min(render_times),
+        'backup': backup_time,
+        'undo': undo_time/max(undos, 1),
+        'history': undos
+    }
+
+
+def measure(name, repeat, seed=0, engine=None, budget=None):
+    # the scenario is timed repeat times from scratch, every timing keeps
+    # its fastest run, the least disturbed by the rest of the machine
+    runs = [measureOnce(name, repeat, seed, engine, budget) for _ in range(repeat)]
+    results = dict(runs[-1])
+    for metric in ['process', 'placement', 'render', 'backup', 'undo']:
+        results[metric] = min(run[metric] for run in runs)
+    return results
+
+
+def measureGeometry(samples=300, seed=0):
+    # closed form overlap areas against shapely on the real map cells
+    rng = np.random.default_rng(seed)
+    originator = OriginatorTruthsayer(meta=json.loads(json.dumps(meta)))
+    processor = originator.processor
+    radius = processor.game_config['dimensions']['troop']/2
+    report = {'circle_error': 0.0, 'polygon_error': 0.0, 'closed_form': 0.0, 'shapely': 0.0}
+    for territory, sector in landingSites(originator):
+        cell = processor.cell(territory, sector)
+        minx, miny, maxx, maxy = cell.bounds
+        centers = np.column_stack([rng.uniform(minx-radius, maxx+radius, samples), rng.uniform(miny-radius, maxy+radius, samples)])
+        start = time.perf_counter()
+        areas = circlePolygonOverlaps(centers, radius, cell)
+        report['closed_form'] += time.perf_counter()-start
+        start = time.perf_counter()
+        shapely.area(shapely.intersection(shapely.buffer(shapely.points(centers), radius), cell.polygon))
+        report['shapely'] += time.perf_counter()-start
+        exact = shapely.area(shapely.intersection(shapely.buffer(shapely.points(centers), radius, quad_segs=1024), cell.polygon))
+        report['polygon_error'] = max(report['polygon_error'], np.max(np.abs(areas-exact))/(np.pi*radius**2))
+    distances = rng.uniform(0, 4*radius, samples)
+    radii = rng.uniform(radius/2, 2*radius, (2, samples))
+    areas = circleOverlaps(distances, radii[0], radii[1])
+    first = shapely.buffer(shapely.points(np.zeros((samples, 2))), radii[0], quad_segs=1024)
+    second = shapely.buffer(shapely.points(np.column_stack([distances, np.zeros(samples)])), radii[1], quad_segs=1024)
+    exact = shapely.area(shapely.intersection(first, second))
+    report['circle_error'] = float(np.max(np.abs(areas-exact)/(np.pi*np.minimum(radii[0], radii[1])**2)))
+    report['polygon_error'] = float(report['polygon_error'])
+    return report
+
+
+def checkIncremental(scale=1.0, seed=0):
+    # incremental renders of small changes against full renders of the same states
+    random.seed(seed)
+    originator, caretaker = scenarioOpening()
+    faction, other = factions(originator)[:2]
+    territory, sector = landingSites(originator)[0]
+    spice = spiceTerritories(originator)[0]
+    steps = [
+        ('ship', lambda: originator.ship(faction, territory, sector, 2)),
+        ('ship again', lambda: originator.ship(faction, territory, sector, 1)),
+        ('ship other', lambda: originator.ship(other, territory, sector, 3)),
+        ('spiceblow', lambda: originator.spiceblow(spice, 6)),
+        ('spiceblow again', lambda: originator.spiceblow(spice, 4)),
+        ('storm S7', lambda: originator.storm('S7')),
+        ('storm S8', lambda: originator.storm('S8'))
+    ]
+    originator.renderFrame(scale=scale)
+    mismatches = []
+    for name, step in steps:
+        step()
+        caretaker.backup()
+        frame = originator.renderFrame(scale=scale)
+        renderer = Renderer(originator._object_state, originator.processor.game_config, originator.cards_manager.card_objects, None, scale=scale)
+        full = renderer.render()
+        difference = ImageChops.difference(frame['image'], full['image'])
+        if difference.getbbox() is not None:
+            mismatches.append((name, max(high for _, high in difference.getextrema())))
+    return mismatches
+
+
+def calibrate(repeat=5):
+    # PIL only image work, tells how fast this machine is compared to the
+    # baseline one without depending on the code being measured
+    board = Image.open(pkg_resources.open_binary(assets, 'map.png')).convert('RGBA')
+    token = Image.new('RGBA', (46, 46), (255, 0, 0, 128))
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        canvas = board.copy()
+        for x in range(0, canvas.size[0]-46, 40):
+            for y in range(0, canvas.size[1]-46, 160):
+                canvas.alpha_composite(token, (x, y))
+        canvas = Image.alpha_composite(canvas, board)
+        canvas.convert('RGB').save(io.BytesIO(), format='JPEG', quality=95)
+        times.append(time.perf_counter()-start)
+    return min(times)
+
+
+def checkReplay(commands=30, seed=0):
+    # replays only store the changed pixels, each format has to fit in the
+    # first frame as a PNG plus the changed pixels taken raw
+    random.seed(seed)
+    _, caretaker = scenarioReplay(commands)
+    states = historyStates(caretaker)
+    replica = OriginatorTruthsayer(game_state=next(states))
+    image = replica.renderFrame()['image']
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    limit = len(buffer.getvalue())
+    for state in states:
+        previous = image
+        replica._object_state = state
+        image = replica.renderFrame()['image']
+        limit += 4*changedMask(previous, image).histogram()[255]+1024
+    sizes = {}
+    for format in ['gif', 'png']:
+        sizes[format] = exportReplay(caretaker, io.BytesIO(), format=format)['bytes']
+    return sizes, limit
+
+
+def compare(results, baseline, tolerance, speed=1.0):
+    # returns the metrics slower than the baseline by more than the tolerance,
+    # the baseline timings are first scaled by the relative speed of this machine
+    regressions = []
+    for scenario, metrics in baseline['results'].items():
+        for metric, reference in metrics.items():
+            if metric in ['placements', 'evaluations', 'violation', 'history'] or scenario not in results:
+                continue
+            reference *= speed
+            value = results[scenario][metric]
+            if value > reference*(1+tolerance) and value-reference > NOISE_FLOOR:
+                regressions.append((scenario, metric, reference, value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Times token placement, processing, rendering and the memento history.')
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS.keys()), choices=list(SCENARIOS.keys()))
+    parser.add_argument('--engine', default=None, choices=list(PLACEMENT_SOLVERS.keys()), help='placement solver used once the slots run out, the configured one by default')
+    parser.add_argument('--budget', type=float, default=None, help='seconds the placement searches of one processing may take')
+    parser.add_argument('--repeat', type=int, default=3, help='times every scenario is run, and renders timed per run, the fastest is reported')
+    parser.add_argument('--output', default=None, help='write the results to this JSON file')
+    parser.add_argument('--baseline', default='benchmark_baseline.json')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='allowed slowdown relative to the baseline, after scaling it to the speed of this machine')
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--geometry', action='store_true', help='only check the closed form overlap areas against shapely')
+    parser.add_argument('--incremental', action='store_true', help='only check incremental renders against full renders')
+    parser.add_argument('--replay', action='store_true', help='only check that replays store no more than the changed pixels')
+    args = parser.parse_args()
+
+    if args.geometry:
+        geometry = measureGeometry()
+        print('closed form {0[closed_form]:.4f}s  shapely {0[shapely]:.4f}s  circle error {0[circle_error]:.2e}  polygon error {0[polygon_error]:.2e}'.format(geometry))
+        if max(geometry['circle_error'], geometry['polygon_error']) > GEOMETRY_TOLERANCE:
+            print('INACCURATE closed form overlap areas')
+            return 1
+        return 0
+
+    if args.incremental:
+        mismatched = False
+        for scale in [1.0, 0.5]:
+            for name, difference in checkIncremental(scale):
+                print('MISMATCH at scale {0} after {1}: up to {2} per channel'.format(scale, name, difference))
+                mismatched = True
+        if mismatched:
+            return 1
+        print('incremental renders match the full renders')
+        return 0
+
+    if args.replay:
+        sizes, limit = checkReplay()
+        oversized = False
+        for format, size in sizes.items():
+            print('{0:<4} replay {1} bytes, at most {2}'.format(format, size, limit))
+            oversized = oversized or size > limit
+        if oversized:
+            print('OVERSIZED replay')
+            return 1
+        return 0
+
+    # calibrated before every scenario, the fastest calibration is the one
+    # least disturbed by the rest of the machine
+    calibrations = []
+    results = {}
+    for name in args.scenarios:
+        calibrations.append(calibrate())
+        results[name] = measure(name, args.repeat, engine=args.engine, budget=args.budget)
+        print('{0:<10} process {1[process]:8.3f}s  placement {1[placement]:8.3f}s ({1[placements]} solves, {1[evaluations]} evaluations, {1[violation]:.0f} px2 off)  render {1[render]:6.3f}s  backup {1[backup]:6.4f}s  undo {1[undo]:6.4f}s'.format(name, results[name]))
+    calibration = min(calibrations)
+    report = {
+        'python': sys.version.split()[0],
+        'engine': args.engine,
+        'budget': args.budget,
+        'repeat': args.repeat,
+        'calibration': calibration,
+        'results': results
+    }
+    if args.output is not None:
+        with open(args.output, 'w') as outfile:
+            json.dump(report, outfile, indent=4)
+    if args.update_baseline:
+        with open(args.baseline, 'w') as outfile:
+            json.dump(report, outfile, indent=4)
+        print('baseline written to {0}'.format(args.baseline))
+        return 0
+    try:
+        with open(args.baseline) as json_file:
+            baseline = json.load(json_file)
+    except FileNotFoundError:
+        print('no baseline at {0}, run with --update-baseline to create one'.format(args.baseline))
+        return 0
+    # baselines without a calibration are taken as from this machine, the
+    # baseline is only ever scaled up, the calibration varies by a fifth
+    # between runs and scaling down would turn that into regressions
+    ratio = calibration/baseline.get('calibration', calibration)
+    speed = max(ratio, 1.0)
+    print('calibration {0:.4f}s, {1:.2f} times the baseline machine'.format(calibration, ratio))
+    regressions = compare(results, baseline, args.tolerance, speed)
+    for scenario, metric, reference, value in regressions:
+        print('REGRESSION {0} {1}: {2:.4f}s -> {3:.4f}s ({4:+.0%})'.format(scenario, metric, reference, value, value/reference-1))
+    if len(regressions) > 0:
+        return 1
+    print('no regressions over {0:.0%} of the baseline'.format(args.tolerance))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,6 @@
 import json
 
-from truthsayer.poly import extract, getRegionsLocations, findNeighboring, findIntersections, findStorm
+from truthsayer.poly import extract, getRegionsLocations, findNeighboring, findIntersections, findStorm, generateSlots
 
 areas = extract()
 regions, locations = getRegionsLocations(areas)
@@ -49,6 +49,9 @@ game_config = None
 with open(filename) as json_file:
     game_config = json.load(json_file)
 
+dimensions = game_config['dimensions']
+slots = generateSlots(areas, locations, location_regions, [dimensions['leader'], dimensions['troop']], skip=['arrakis'])
+
 game_config['generated'] = {
     'territories': areas,
     'sectors': regions,
@@ -56,6 +59,7 @@ game_config['generated'] = {
     'location_regions': location_regions,
     'neighbors': neighbors,
     'neighborhoods': neighborhoods,
+    'slots': slots,
     'map_center': {
         'x': cx,
         'y': cy,
@@ -0,0 +1,146 @@
+import math
+import threading
+
+from truthsayer.cache import LRUCache
+from truthsayer.sprites import sprites
+
+
+# the board only ever shows these wheel dial values and storm sectors
+WHEEL_VALUES = list(range(21))
+STORM_POSITIONS = list(range(1, 19))
+
+
+def stormCenter(game_config):
+    cx = game_config['generated']['map_center']['x']
+    cy = game_config['generated']['map_center']['y']
+    cr = game_config['generated']['map_center']['r']+7
+    return cx, cy, cr
+
+
+def wheelAngle(value):
+    return 360*(value+1.25)/21
+
+
+def stormObject(center, position, token, scale=0.5):
+    cx, cy, cr = center
+    angle = (position-6.5)*360/18
+    angle_rot = angle - 90
+    angle_rad = 2*math.pi*(-angle)/360
+    x = cx+math.cos(angle_rad)*cr
+    y = cy+math.sin(angle_rad)*cr
+    return {
+        'token': token,
+        'x': x,
+        'y': y,
+        's': scale,
+        'a': angle_rot,
+    }
+
+
+def cropToCanvas(token, x, y):
+    # centers the sprite on (x, y) and cuts away whatever sticks out
+    # above or left of the canvas, returns the sprite and its target box
+    width_token, height_token = token.size
+    x_diff = int(math.ceil(x - int(math.floor(width_token/2))))
+    if x_diff < 0:
+        box = (
+            -x_diff,
+            0,
+            width_token,
+            height_token
+        )
+        token = token.crop(box)
+        width_token, height_token = token.size
+        x = 0
+    else:
+        x -= int(math.floor(width_token/2))
+    y_diff = int(math.ceil(y - int(math.floor(height_token/2))))
+    if y_diff < 0:
+        box = (
+            0,
+            -y_diff,
+            width_token,
+            height_token
+        )
+        token = token.crop(box)
+        width_token, height_token = token.size
+        y = 0
+    else:
+        y -= int(math.floor(height_token/2))
+    box_target = (
+        int(x),
+        int(y),
+        int(x+width_token),
+        int(y+height_token))
+    return token, box_target
+
+
+# battle wheel top and the numbers dial at every dial angle
+class WheelAtlas:
+    def __init__(self, width):
+        self.width = width
+        self.top = None
+        self.numbers = {}
+        self._lock = threading.Lock()
+
+    def build(self):
+        with self._lock:
+            if self.top is not None:
+                return self
+            size = self.width, self.width
+            for value in WHEEL_VALUES:
+                angle = wheelAngle(value)
+                self.numbers[angle] = sprites.get('battle_wheel_numbers.png', size, angle)
+            self.top = sprites.get('battle_wheel_top.png', size)
+        return self
+
+    def getNumbers(self, angle):
+        token = self.numbers.get(angle, None)
+        if token is None:
+            token = sprites.get('battle_wheel_numbers.png', (self.width, self.width), angle)
+        return token
+
+
+# storm marker for every sector, already rotated and cropped
+class StormAtlas:
+    def __init__(self, center, token, scale=0.5):
+        self.center = center
+        self.token = token
+        self.scale = scale
+        self.frames = {}
+        self._lock = threading.Lock()
+
+    def build(self):
+        with self._lock:
+            if len(self.frames) > 0:
+                return self
+            for position in STORM_POSITIONS:
+                storm_object = stormObject(self.center, position, self.token, self.scale)
+                self.frames[self.frameKey(storm_object)] = self.place(storm_object)
+        return self
+
+    def frameKey(self, storm_object):
+        # scaled previews compute the same position in a different order
+        return tuple(round(storm_object[key], 6) for key in ['x', 'y', 'a'])
+
+    def place(self, storm_object):
+        token = sprites.scaled(storm_object['token'], storm_object['s'], storm_object['a'])
+        return cropToCanvas(token, storm_object['x'], storm_object['y'])
+
+    def get(self, storm_object):
+        frame = self.frames.get(self.frameKey(storm_object), None)
+        if frame is None:
+            frame = self.place(storm_object)
+        return frame
+
+
+atlases = LRUCache(16)
+
+
+def getWheelAtlas(width):
+    return atlases.fetch(('wheel', width), lambda: WheelAtlas(width)).build()
+
+
+def getStormAtlas(center, token, scale=0.5):
+    key = 'storm', tuple(center), token, scale
+    return atlases.fetch(key, lambda: StormAtlas(center, token, scale)).build()
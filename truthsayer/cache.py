@@ -0,0 +1,193 @@
+import os
+import abc
+import threading
+
+from collections import OrderedDict
+
+
+# thread-safe LRU mapping bounded by the total weight of its entries, one
+# per entry by default, an entry heavier than the capacity is never stored
+class LRUCache:
+    def __init__(self, capacity, weigh=None):
+        self.capacity = capacity
+        self.weigh = weigh if weigh is not None else (lambda value: 1)
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value):
+        weight = self.weigh(value)
+        with self._lock:
+            if key in self._entries:
+                self.weight -= self._entries.pop(key)[1]
+            if weight > self.capacity:
+                return value
+            self._entries[key] = (value, weight)
+            self.weight += weight
+            while self.weight > self.capacity:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.weight -= evicted
+                self.evictions += 1
+        return value
+
+    def fetch(self, key, factory):
+        # the factory runs outside of the lock so that slow loads of
+        # different keys do not serialize, at worst a value is built twice
+        missing = object()
+        value = self.get(key, missing)
+        if value is not missing:
+            return value
+        return self.put(key, factory())
+
+    def discard(self, key):
+        with self._lock:
+            if key in self._entries:
+                self.weight -= self._entries.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.weight = 0
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'weight': self.weight,
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+# memory LRU in front of files shared by the processes using directory,
+# least recently used keys are removed past max_disk_bytes, subclasses name
+# the files of a key with suffixes and convert values to their contents
+class TieredCache(abc.ABC):
+    suffixes = ()
+
+    def __init__(self, memory, directory=None, max_disk_bytes=None):
+        self.memory = memory
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        # bytes on disk and the directory they were counted in, other
+        # processes writing there are only seen when it is counted again
+        self.disk_bytes = None
+        self.counted = None
+        self.disk_hits = 0
+
+    @abc.abstractmethod
+    def dump(self, value):
+        pass
+
+    @abc.abstractmethod
+    def load(self, contents):
+        pass
+
+    def paths(self, key):
+        return [os.path.join(self.directory, key + suffix) for suffix in self.suffixes]
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None or self.directory is None:
+            return value
+        paths = self.paths(key)
+        try:
+            contents = []
+            for path in paths:
+                with open(path, 'rb') as f:
+                    contents.append(f.read())
+            value = self.load(contents)
+        except (OSError, ValueError, KeyError):
+            return None
+        try:
+            # the modification time orders the keys by their last use
+            os.utime(paths[0])
+        except OSError:
+            pass
+        self.disk_hits += 1
+        return self.memory.put(key, value)
+
+    def put(self, key, value):
+        self.memory.put(key, value)
+        if self.directory is None:
+            return value
+        os.makedirs(self.directory, exist_ok=True)
+        contents = self.dump(value)
+        # written under temporary names unique to the process first, readers
+        # never see partial files
+        for path, content in zip(self.paths(key), contents):
+            temporary = '{0}.{1}.tmp'.format(path, os.getpid())
+            with open(temporary, 'wb') as f:
+                f.write(content)
+            os.replace(temporary, path)
+        if self.max_disk_bytes is not None:
+            if self.counted != self.directory:
+                self.disk_bytes = sum(size for _, size, _ in self.diskEntries())
+                self.counted = self.directory
+            else:
+                self.disk_bytes += sum(len(content) for content in contents)
+            if self.disk_bytes > self.max_disk_bytes:
+                self.evict()
+        return value
+
+    def diskEntries(self):
+        # (last use, bytes, key) of every key on disk
+        entries = []
+        primary = self.suffixes[0]
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(primary):
+                continue
+            key = filename[:-len(primary)]
+            try:
+                stats = [os.stat(path) for path in self.paths(key)]
+            except OSError:
+                continue
+            entries.append((stats[0].st_mtime, sum(stat.st_size for stat in stats), key))
+        return entries
+
+    def evict(self):
+        # removes the least recently used keys until a tenth of the bound is
+        # free again
+        entries = sorted(self.diskEntries())
+        self.disk_bytes = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if self.disk_bytes <= 0.9*self.max_disk_bytes:
+                break
+            for path in self.paths(key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self.disk_bytes -= size
+
+    def clear(self, disk=False):
+        self.memory.clear()
+        if disk and self.directory is not None and os.path.isdir(self.directory):
+            for filename in os.listdir(self.directory):
+                if any(filename.endswith(suffix) for suffix in self.suffixes):
+                    os.remove(os.path.join(self.directory, filename))
+            self.counted = None
+
+    def stats(self):
+        stats = self.memory.stats()
+        stats['disk_hits'] = self.disk_hits
+        return stats
@@ -0,0 +1,116 @@
+import io
+import time
+
+from PIL import Image
+
+
+FORMATS = {
+    'jpeg': 'JPEG',
+    'jpg': 'JPEG',
+    'webp': 'WEBP',
+    'png': 'PNG'
+}
+LOSSY_FORMATS = ['JPEG', 'WEBP']
+
+
+def formatOf(outfile, default='jpeg'):
+    # guesses the codec from the extension of the target path
+    if isinstance(outfile, str):
+        extension = '.' + outfile.rsplit('.', 1)[-1].lower()
+        guessed = Image.registered_extensions().get(extension, None)
+        if guessed is not None and guessed.lower() in FORMATS.keys():
+            return guessed.lower()
+    return default
+
+
+class EncodedImage:
+    def __init__(self, data, format, quality, width, height, encode_time, attempts=1, fits=True):
+        self.data = data
+        self.format = format
+        self.quality = quality
+        self.width = width
+        self.height = height
+        self.encode_time = encode_time
+        self.attempts = attempts
+        self.fits = fits
+
+    @property
+    def size(self):
+        return len(self.data)
+
+    @property
+    def mimetype(self):
+        return Image.MIME[self.format]
+
+    def fileobj(self):
+        return io.BytesIO(self.data)
+
+    def save(self, outfile):
+        if hasattr(outfile, 'write'):
+            outfile.write(self.data)
+            return None
+        with open(outfile, 'wb') as f:
+            f.write(self.data)
+
+    def report(self):
+        return {
+            'format': self.format,
+            'quality': self.quality,
+            'width': self.width,
+            'height': self.height,
+            'bytes': self.size,
+            'encode_time': self.encode_time,
+            'attempts': self.attempts,
+            'fits': self.fits
+        }
+
+
+def encodeOnce(image, format, quality, optimize, progressive):
+    params = {}
+    if format == 'JPEG':
+        params = {'quality': quality, 'optimize': optimize, 'progressive': progressive}
+    elif format == 'WEBP':
+        params = {'quality': quality, 'method': 6 if optimize else 4}
+    elif format == 'PNG':
+        params = {'optimize': optimize}
+    buffer = io.BytesIO()
+    image.save(buffer, format=format, **params)
+    return buffer.getvalue()
+
+
+def encode(image, format='jpeg', quality=95, optimize=False, progressive=False, max_bytes=None, min_quality=10):
+    # with max_bytes set the highest quality between min_quality and quality
+    # that fits is found by bisection, else the smallest attempt is returned
+    # with fits unset
+    if format.lower() not in FORMATS.keys():
+        raise ValueError('Unsupported image format {0}'.format(format))
+    format = FORMATS[format.lower()]
+    if image.mode not in ['RGB', 'L'] and format == 'JPEG':
+        image = image.convert('RGB')
+    width, height = image.size
+    start = time.perf_counter()
+    data = encodeOnce(image, format, quality, optimize, progressive)
+    attempts = 1
+    if format not in LOSSY_FORMATS:
+        fits = max_bytes is None or len(data) <= max_bytes
+        return EncodedImage(data, format, None, width, height, time.perf_counter()-start, attempts, fits)
+    if max_bytes is None or len(data) <= max_bytes:
+        return EncodedImage(data, format, quality, width, height, time.perf_counter()-start, attempts, True)
+    best, best_quality = None, None
+    smallest, smallest_quality = data, quality
+    low, high = min_quality, quality-1
+    while low <= high:
+        middle = (low+high)//2
+        attempt = encodeOnce(image, format, middle, optimize, progressive)
+        attempts += 1
+        if len(attempt) < len(smallest):
+            smallest, smallest_quality = attempt, middle
+        if len(attempt) <= max_bytes:
+            best, best_quality = attempt, middle
+            low = middle+1
+        else:
+            high = middle-1
+    encode_time = time.perf_counter()-start
+    if best is None:
+        return EncodedImage(smallest, format, smallest_quality, width, height, encode_time, attempts, False)
+    return EncodedImage(best, format, best_quality, width, height, encode_time, attempts, True)
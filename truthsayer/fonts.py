@@ -0,0 +1,42 @@
+import io
+
+from PIL import ImageFont
+
+try:
+    import importlib.resources as pkg_resources
+except ImportError:
+    # Try backported to PY<37 `importlib_resources`.
+    import importlib_resources as pkg_resources
+
+from truthsayer import assets
+from truthsayer.cache import LRUCache
+
+
+# font files are read once and each file and size parsed once, the fonts
+# are shared by every renderer and thread
+class FontRegistry:
+    def __init__(self, max_fonts=64):
+        self.files = {}
+        # sizes follow the render scale, the fonts of unused scales are dropped
+        self.fonts = LRUCache(max_fonts)
+
+    def read(self, filename):
+        data = self.files.get(filename, None)
+        if data is None:
+            data = pkg_resources.read_binary(assets, filename)
+            self.files[filename] = data
+        return data
+
+    def get(self, filename, size):
+        return self.fonts.fetch((filename, size), lambda: ImageFont.truetype(io.BytesIO(self.read(filename)), size))
+
+    def warm(self, entries):
+        for filename, size in entries:
+            self.get(filename, size)
+
+    def clear(self):
+        self.files = {}
+        self.fonts.clear()
+
+
+fonts = FontRegistry()
@@ -0,0 +1,102 @@
+import math
+
+import shapely
+import numpy as np
+
+from shapely.geometry.polygon import orient
+
+
+def polygonEdges(polygon):
+    # edges of all rings as an (E, 2, 2) array, exteriors counterclockwise and
+    # holes clockwise so that signed areas over the edges sum to the area
+    edges = []
+    for part in shapely.get_parts(polygon):
+        if part.geom_type != 'Polygon' or part.is_empty:
+            continue
+        part = orient(part, 1.0)
+        for ring in [part.exterior] + list(part.interiors):
+            coords = np.asarray(ring.coords)
+            segments = np.stack([coords[:-1], coords[1:]], axis=1)
+            edges.append(segments[np.any(segments[:, 0] != segments[:, 1], axis=1)])
+    if len(edges) == 0:
+        return np.zeros((0, 2, 2))
+    return np.concatenate(edges)
+
+
+# static geometry of a territory or a territory and sector intersection,
+# the polygon is prepared and its area, centroid, bounds and edges kept
+class Cell:
+    def __init__(self, polygon):
+        shapely.prepare(polygon)
+        self.polygon = polygon
+        self.area = polygon.area
+        centroid = polygon.centroid
+        self.centroid = centroid.x, centroid.y
+        self.bounds = polygon.bounds
+        self.edges = polygonEdges(polygon)
+
+
+def asCell(polygon):
+    if isinstance(polygon, Cell):
+        return polygon
+    return Cell(polygon)
+
+
+def discArea(radius):
+    return math.pi*radius**2
+
+
+def circleOverlaps(distances, radius1, radius2):
+    # exact intersection areas of circles with centers the given distances apart
+    d = np.asarray(distances, dtype=float)
+    r1 = np.broadcast_to(np.asarray(radius1, dtype=float), d.shape)
+    r2 = np.broadcast_to(np.asarray(radius2, dtype=float), d.shape)
+    small = np.minimum(r1, r2)
+    areas = np.where(d <= np.abs(r1-r2), np.pi*small**2, 0.0)
+    lens = (d < r1+r2) & (d > np.abs(r1-r2))
+    if lens.any():
+        d, r1, r2 = d[lens], r1[lens], r2[lens]
+        alpha = np.arccos(np.clip((d**2+r1**2-r2**2)/(2*d*r1), -1, 1))
+        beta = np.arccos(np.clip((d**2+r2**2-r1**2)/(2*d*r2), -1, 1))
+        areas[lens] = r1**2*(alpha-np.sin(2*alpha)/2)+r2**2*(beta-np.sin(2*beta)/2)
+    return areas
+
+
+def sectorAreas(p, q, radius):
+    # signed area of the circle sector between the directions of p and q
+    cross = p[..., 0]*q[..., 1]-p[..., 1]*q[..., 0]
+    dot = p[..., 0]*q[..., 0]+p[..., 1]*q[..., 1]
+    return radius**2*np.arctan2(cross, dot)/2
+
+
+def triangleAreas(p, q):
+    return (p[..., 0]*q[..., 1]-p[..., 1]*q[..., 0])/2
+
+
+def circlePolygonOverlaps(centers, radius, cell):
+    # exact intersection areas of circles of one radius with a cell, summed
+    # over the edges, each adding the part of the triangle it spans with the
+    # center that lies inside of the circle, circles missing the bounds are skipped
+    centers = np.asarray(centers, dtype=float).reshape(-1, 2)
+    areas = np.zeros(len(centers))
+    minx, miny, maxx, maxy = cell.bounds
+    near = (centers[:, 0]+radius > minx) & (centers[:, 0]-radius < maxx) & (centers[:, 1]+radius > miny) & (centers[:, 1]-radius < maxy)
+    if not near.any() or len(cell.edges) == 0:
+        return areas
+    a = cell.edges[None, :, 0, :]-centers[near][:, None, :]
+    b = cell.edges[None, :, 1, :]-centers[near][:, None, :]
+    d = b-a
+    # the edge crosses the circle at the roots of |a+t*d| = radius
+    qa = np.sum(d*d, axis=2)
+    qb = 2*np.sum(a*d, axis=2)
+    qc = np.sum(a*a, axis=2)-radius**2
+    discriminant = qb**2-4*qa*qc
+    root = np.sqrt(np.maximum(discriminant, 0))
+    crossing = discriminant > 0
+    t1 = np.where(crossing, np.clip((-qb-root)/(2*qa), 0, 1), 1)[..., None]
+    t2 = np.where(crossing, np.clip((-qb+root)/(2*qa), 0, 1), 1)[..., None]
+    p1 = a+t1*d
+    p2 = a+t2*d
+    signed = sectorAreas(a, p1, radius)+triangleAreas(p1, p2)+sectorAreas(p2, b, radius)
+    areas[near] = np.clip(np.sum(signed, axis=1), 0, discArea(radius))
+    return areas
@@ -1,11 +1,15 @@
 import math
+import time
 import random
 
+import numpy as np
+
 from shapely.geometry.point import Point
 
 from simpleai.search import SearchProblem
 
 from truthsayer.poly import generate_random
+from truthsayer.geometry import asCell, discArea, circleOverlaps, circlePolygonOverlaps
 
 
 def rotateAboutPoint(ox, oy, px, py, angle):
@@ -17,19 +21,42 @@ def rotateAboutPoint(ox, oy, px, py, angle):
 def shiftFromPoint(ox, oy, px, py, delta):
     if -1 < px-ox < 1:
         # slope is practically vertical in px dimensions
-        return px, px + delta
+        return px, py + delta
     m = (py-oy)/(px-ox)
     nx = px + delta
-    ny = py + m*delta + oy
+    ny = py + m*delta
     return nx, ny
 
 
+def splitAvoidAreas(areas):
+    # tokens to avoid come as (x, y, radius) circles, other areas as polygons
+    circles = [area for area in areas if isinstance(area, (tuple, list))]
+    cells = [asCell(area) for area in areas if not isinstance(area, (tuple, list))]
+    return np.asarray(circles, dtype=float).reshape(-1, 3), cells
+
+
+def avoidPenalties(centers, radius, circles, cells):
+    # cubed and plain sums of the areas overlapping what is to be avoided
+    bad = np.zeros(len(centers))
+    overlap = np.zeros(len(centers))
+    if len(circles) > 0:
+        distances = np.sqrt(np.sum((centers[:, None, :]-circles[None, :, :2])**2, axis=2))
+        areas = circleOverlaps(distances, radius, circles[None, :, 2])
+        bad += np.sum(areas**3, axis=1)
+        overlap += np.sum(areas, axis=1)
+    for cell in cells:
+        areas = circlePolygonOverlaps(centers, radius, cell)
+        bad += areas**3
+        overlap += areas
+    return bad, overlap
+
+
 def distance(ox, oy, px, py):
     return math.sqrt((ox-px)**2+(oy-py)**2)
 
 
-def mutant(state, polygon):
-    ox, oy = polygon.centroid.x, polygon.centroid.y
+def mutant(state, centroid):
+    ox, oy = centroid
     px, py = state
     rnd = random.random()
     if rnd < 0.5:
@@ -42,9 +69,12 @@ def mutant(state, polygon):
 
 class TokenPlacementProblem(SearchProblem):
     def __init__(self, polygons_maximize_overlap, polygons_avoid_overlap_areas, target_radius, tolerance=0.1, initial_state=None):
-        self.polygons_maximize_overlap = polygons_maximize_overlap
+        self.cell = asCell(polygons_maximize_overlap)
+        self.polygons_maximize_overlap = self.cell.polygon
         self.polygons_avoid_overlap_areas = polygons_avoid_overlap_areas
+        self.avoid_circles, self.avoid_cells = splitAvoidAreas(polygons_avoid_overlap_areas)
         self.target_radius = target_radius
+        self.radii = [target_radius]
         self.tolerance = tolerance
         if initial_state is None:
             initial_state = self.generate_random_state()
@@ -57,21 +87,23 @@ class TokenPlacementProblem(SearchProblem):
 
     def heuristic(self, state):
         # how far are we from the goal?
-        bad = 0
-        state_polygon = self.polygonize(state)
-        for avoid in self.polygons_avoid_overlap_areas:
-            area = state_polygon.intersection(avoid).area
-            bad += area**3
-        overlap = (state_polygon.intersection(self.polygons_maximize_overlap).area)
-        if overlap < state_polygon.area - self.tolerance:
-            centroid = self.polygons_maximize_overlap.centroid
-            px, py = state
-            ox, oy = centroid.x, centroid.y
-            bad += ((px - ox)**2 + (py - oy)**2)**5
-        else:
-            bad -= overlap
+        return float(self.heuristics([state])[0])
+
+    def heuristics(self, states):
+        bad, _ = self.evaluate(states)
         return bad
 
+    def evaluate(self, states):
+        # scores a whole population at once, along with the area it overlaps
+        # other tokens or sticks out of the cell
+        centers = np.asarray(states, dtype=float).reshape(-1, 2)
+        bad, violation = avoidPenalties(centers, self.target_radius, self.avoid_circles, self.avoid_cells)
+        overlap = circlePolygonOverlaps(centers, self.target_radius, self.cell)
+        missing = discArea(self.target_radius) - overlap
+        distances = np.sum((centers-self.cell.centroid)**2, axis=1)
+        bad += np.where(missing > self.tolerance, distances**5, -overlap)
+        return bad, violation + np.maximum(missing, 0)
+
     def crossover(self, state1, state2):
         x1, y1 = state1
         x2, y2 = state2
@@ -82,7 +114,12 @@ class TokenPlacementProblem(SearchProblem):
             return x2, y1
 
     def mutate(self, state):
-        return mutant(state, self.polygons_maximize_overlap)
+        return mutant(state, self.cell.centroid)
+
+    def stateOf(self, centers):
+        # the state of an (N, 2) array of token centers
+        x, y = centers[0]
+        return float(x), float(y)
 
     def generate_random_state(self):
         state_center = generate_random(1, self.polygons_maximize_overlap, centroid=True)[0]
@@ -97,9 +134,12 @@ class TokenPlacementProblem(SearchProblem):
 class MultiTokenPlacementProblem(SearchProblem):
     def __init__(self, polygons_maximize_overlap, polygons_avoid_overlap_areas, target_radii, tolerance=0.1, initial_state=None):
         self.N = len(target_radii)
-        self.polygons_maximize_overlap = polygons_maximize_overlap
+        self.cell = asCell(polygons_maximize_overlap)
+        self.polygons_maximize_overlap = self.cell.polygon
         self.polygons_avoid_overlap_areas = polygons_avoid_overlap_areas
+        self.avoid_circles, self.avoid_cells = splitAvoidAreas(polygons_avoid_overlap_areas)
         self.target_radii = target_radii
+        self.radii = list(target_radii)
         self.tolerance = tolerance
         if initial_state is None:
             initial_state = self.generate_random_state()
@@ -110,34 +150,31 @@ class MultiTokenPlacementProblem(SearchProblem):
         state_center = Point(x, y)
         return state_center.buffer(radius)
 
-    # slow, but not meant to be used for more than
-    # N=2 or N=3 polygons simultaneously
     def heuristic(self, state):
         # how far are we from the goal?
-        bad = 0
-        for j in range(self.N):
-            px, py = state[2*j], state[2*j+1]
-            radius = self.target_radii[j]
-            state_polygon = self.polygonize((px, py), radius)
-            for avoid in self.polygons_avoid_overlap_areas:
-                area = state_polygon.intersection(avoid).area
-                bad += area**3
-            overlap = (state_polygon.intersection(self.polygons_maximize_overlap).area)
-            if overlap < state_polygon.area - self.tolerance:
-                centroid = self.polygons_maximize_overlap.centroid
-                # ox, oy = centroid.x, centroid.y
-                # bad += ((px - ox)**2 + (py - oy)**2)**6
-                bad += state_polygon.area - overlap
-                # print('punish')
-            #else:
-            #    bad -= overlap
+        return float(self.heuristics([state])[0])
+
+    def heuristics(self, states):
+        bad, _ = self.evaluate(states)
+        return bad
+
+    def evaluate(self, states):
+        # scores a whole population at once, token by token and pair by pair,
+        # along with the area overlapping other tokens or sticking out of the cell
+        centers = np.asarray(states, dtype=float).reshape(-1, self.N, 2)
+        bad = np.zeros(len(centers))
+        violation = np.zeros(len(centers))
+        for j, radius in enumerate(self.target_radii):
+            penalty, overlap = avoidPenalties(centers[:, j], radius, self.avoid_circles, self.avoid_cells)
+            missing = np.maximum(discArea(radius) - circlePolygonOverlaps(centers[:, j], radius, self.cell), 0)
+            bad += penalty + np.where(missing > self.tolerance, missing, 0)
+            violation += overlap + missing
             for k in range(j+1, self.N):
-                pkx, pky = state[2*k], state[2*k+1]
-                radiusk = self.target_radii[k]
-                state_polygon_k = self.polygonize((pkx, pky), radiusk)
-                collision = state_polygon.intersection(state_polygon_k).area
+                distances = np.sqrt(np.sum((centers[:, j]-centers[:, k])**2, axis=1))
+                collision = circleOverlaps(distances, radius, self.target_radii[k])
                 bad += collision
-        return bad
+                violation += collision
+        return bad, violation
 
     def crossover(self, mother, father):
         rnd = random.random()
@@ -162,11 +199,15 @@ class MultiTokenPlacementProblem(SearchProblem):
         mutated = list(state)
         for j in xmen:
             px, py = state[2*j], state[2*j+1]
-            nx, ny = mutant((px, py), self.polygons_maximize_overlap)
+            nx, ny = mutant((px, py), self.cell.centroid)
             mutated[2*j] = nx
             mutated[2*j+1] = ny
         return mutated
 
+    def stateOf(self, centers):
+        # the state of an (N, 2) array of token centers
+        return [float(v) for v in np.ravel(centers)]
+
     def generate_random_state(self):
         state_centers = generate_random(self.N, self.polygons_maximize_overlap, centroid=True)
         state = []
@@ -178,3 +219,66 @@ class MultiTokenPlacementProblem(SearchProblem):
     def value(self, state):
         # how good is this state?
         return -self.heuristic(state)
+
+
+class Solution:
+    def __init__(self, state, value, violation, evaluations=0, iterations=0, reason=None):
+        self.state = state
+        self.value = value
+        self.violation = violation
+        self.evaluations = evaluations
+        self.iterations = iterations
+        self.reason = reason
+
+    def valid(self, tolerance):
+        return self.violation <= tolerance
+
+
+def stopReason(problem, solution, iteration, iterations_limit, deadline, stop_when_valid):
+    # why an anytime search should stop now, None to go on
+    if stop_when_valid and solution.valid(problem.tolerance):
+        return 'valid'
+    if iteration >= iterations_limit:
+        return 'iterations'
+    if deadline is not None and time.perf_counter() >= deadline:
+        return 'budget'
+    return None
+
+
+def evolve(problem, population_size=100, mutation_chance=0.1, iterations_limit=100, budget=None, stop_when_valid=True):
+    # follows simpleai genetic, but parents are drawn with weights by rank and
+    # the best state ever seen is returned, every generation is scored with one
+    # batched evaluation until stopReason gives a reason to stop
+    deadline = None if budget is None else time.perf_counter()+budget
+    population = [problem.generate_random_state() for _ in range(population_size)]
+    bad, violations = problem.evaluate(population)
+    values = -bad
+    best = int(np.argmax(values))
+    solution = Solution(population[best], values[best], violations[best])
+    evaluations = len(population)
+    iteration = 0
+    while True:
+        reason = stopReason(problem, solution, iteration, iterations_limit, deadline, stop_when_valid)
+        if reason is not None:
+            break
+        ranks = np.empty(len(population))
+        ranks[np.argsort(values)] = np.arange(1, len(population)+1)
+        parents = random.choices(population, weights=ranks, k=2*len(population))
+        generation = []
+        for mother, father in zip(parents[0::2], parents[1::2]):
+            child = problem.crossover(mother, father)
+            if random.random() < mutation_chance:
+                child = problem.mutate(child)
+            generation.append(child)
+        population = generation
+        bad, violations = problem.evaluate(population)
+        values = -bad
+        evaluations += len(population)
+        iteration += 1
+        best = int(np.argmax(values))
+        if values[best] > solution.value:
+            solution = Solution(population[best], values[best], violations[best])
+    solution.evaluations = evaluations
+    solution.iterations = iteration
+    solution.reason = reason
+    return solution
@@ -0,0 +1,38 @@
+import json
+import hashlib
+
+from truthsayer.cache import LRUCache, TieredCache
+
+
+def placementKey(territory_name, sector_name, radii, placed, solver):
+    # radii in their order, placed as (x, y, radius) in any order, positions
+    # rounded to a tenth of a pixel
+    content = {
+        'territory': territory_name,
+        'sector': sector_name,
+        'radii': [float(radius) for radius in radii],
+        'placed': sorted([round(float(v), 1) for v in circle] for circle in placed),
+        'solver': solver
+    }
+    data = json.dumps(content, sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+# solved token placements keyed by the digest of their problem
+class PlacementCache(TieredCache):
+    suffixes = ('.json',)
+
+    def __init__(self, max_entries=4096, directory=None, max_disk_bytes=64*2**20):
+        super().__init__(LRUCache(max_entries), directory, max_disk_bytes)
+
+    def put(self, key, state):
+        return super().put(key, [float(v) for v in state])
+
+    def dump(self, state):
+        return [json.dumps({'state': state}).encode('utf-8')]
+
+    def load(self, contents):
+        return json.loads(contents[0])['state']
+
+
+placement_results = PlacementCache()
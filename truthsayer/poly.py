@@ -1,6 +1,8 @@
 import random
 import math
 import pareto
+import shapely
+import numpy as np
 
 from itertools import compress
 
@@ -122,6 +124,50 @@ def findStorm(areas):
     return cx, cy, r
 
 
+def findSlots(polygon, radius, count, step=4, tolerance=1):
+    # greedy packing of discs inside the polygon, each slot is the grid point
+    # farthest from the border and the slots already taken
+    minx, miny, maxx, maxy = polygon.bounds
+    xs, ys = np.meshgrid(np.arange(minx, maxx+step, step), np.arange(miny, maxy+step, step))
+    xs, ys = xs.ravel(), ys.ravel()
+    inside = shapely.contains_xy(polygon, xs, ys)
+    xs, ys = xs[inside], ys[inside]
+    if len(xs) == 0:
+        return []
+    clearance = shapely.distance(polygon.boundary, shapely.points(xs, ys))
+    room = np.where(clearance >= radius-tolerance, np.inf, -np.inf)
+    slots = []
+    while len(slots) < count:
+        score = np.where(room >= radius, np.minimum(clearance, room), -np.inf)
+        j = int(np.argmax(score))
+        if score[j] == -np.inf:
+            break
+        slots.append((float(xs[j]), float(ys[j])))
+        room = np.minimum(room, np.sqrt((xs-xs[j])**2+(ys-ys[j])**2)-radius)
+    return slots
+
+
+def generateSlots(areas, locations, location_regions, diameters, count=8, skip=[]):
+    # slots[territory][sector][diameter] lists token centers, best first
+    slots = {}
+    for territory in locations:
+        if territory in skip:
+            continue
+        sectors = location_regions.get(territory, [])
+        territory_polygon = Polygon(areas['polygons'][territory])
+        cells = {'whole': territory_polygon}
+        for sector in sectors:
+            sector_polygon = Polygon(areas['polygons'][sector.replace('S', 'R')])
+            cells[sector] = territory_polygon.intersection(sector_polygon)
+        slots[territory] = {}
+        for sector, cell in cells.items():
+            slots[territory][sector] = {}
+            for diameter in diameters:
+                centers = findSlots(cell, diameter/2, count)
+                slots[territory][sector][str(diameter)] = [[round(x, 1), round(y, 1)] for x, y in centers]
+    return slots
+
+
 def generate_random(number, polygon, centroid=False):
     points = []
     minx, miny, maxx, maxy = polygon.bounds
@@ -1,17 +1,26 @@
-import math
+import time
 import random
+import copy
 import json
+import asyncio
+import functools
 
-from shapely.geometry import Polygon
-from shapely.geometry.point import Point
+import numpy as np
 
-from simpleai.search.local import genetic
+from shapely.geometry import Polygon
 
 from brackette.memento import OriginatorJSON, Caretaker
 
 from truthsayer.opti import TokenPlacementProblem
 from truthsayer.opti import MultiTokenPlacementProblem
+from truthsayer.solvers import solve
+from truthsayer.placements import placementKey, placement_results
+from truthsayer.geometry import Cell
 from truthsayer.renderer import Renderer
+from truthsayer.atlas import stormCenter, stormObject, wheelAngle
+from truthsayer.encoding import encode, formatOf
+from truthsayer.results import renderDigest, render_results
+from truthsayer.profiling import NULL_PROFILER
 
 
 try:
@@ -392,11 +401,17 @@ class ConfigManager:
     def getPolygonArea(self, territory_name):
         return self.game_config['generated']['territories']['polygons'][territory_name]
 
+    def getSectorArea(self, sector_name):
+        # sector polygons are stored under the R prefix of the vectorized map
+        return self.getPolygonArea(sector_name.replace('S', 'R'))
+
+    def getSlots(self, territory_name, sector_name, radius):
+        # precomputed token centers of the cell, best first
+        slots = self.game_config['generated'].get('slots', {}).get(territory_name, {}).get(sector_name, {})
+        return slots.get(str(int(2*radius)), [])
+
     def getCenter(self):
-         cx = self.game_config['generated']['map_center']['x']
-         cy = self.game_config['generated']['map_center']['y']
-         cr = self.game_config['generated']['map_center']['r']+7
-         return cx, cy, cr
+         return stormCenter(self.game_config)
 
     def getFile(self, token_name):
         return self.game_config['files'][token_name]
@@ -407,67 +422,139 @@ class ConfigManager:
     def getFactionName(self, faction_key):
         return self.game_config['faction_names'][faction_key]
 
+# cells of the map never change, all processors share them
+map_cells = {}
+
+
 class RenderingProcessor:
     def __init__(self):
         self.manager = ConfigManager()
         self.game_config = self.manager.game_config
-
-    def prepareInstance(self, game_state, territory_name, sector_name):
+        self.profiler = NULL_PROFILER
+        # solver placing the tokens that find no free slot, one of PLACEMENT_SOLVERS
+        self.engine = self.game_config.get('placement', {}).get('solver', 'genetic')
+        self.cells = map_cells
+        # seconds the placement searches of one process call may take in total, None for no limit
+        self.budget = None
+        self.deadline = None
+        # evaluations spent by all placement searches so far and the area
+        # their placements overlap other tokens or stick out of the sectors
+        self.evaluations = 0
+        self.violation = 0.0
+        # solved placements shared across games, None to always search
+        self.placements = placement_results
+
+    def cellPolygon(self, territory_name, sector_name):
         polygons_maximize_overlap = Polygon(self.manager.getPolygonArea(territory_name))
         # print(polygons_maximize_overlap.svg())
         # print(polygons_maximize_overlap.territory)
         if sector_name != 'whole':
             # print('making sector')
-            polygons_region = Polygon(self.manager.getPolygonArea(sector_name))
+            polygons_region = Polygon(self.manager.getSectorArea(sector_name))
             # print(polygons_region.svg())
             # print(polygons_region.territory)
             polygons_maximize_overlap = polygons_maximize_overlap.intersection(polygons_region)
             # print(polygons_maximize_overlap.svg())
             # print(polygons_maximize_overlap.territory)
-        avoid_overlap_territories = []
+        return polygons_maximize_overlap
+
+    def cell(self, territory_name, sector_name):
+        # cells never change, they are built on first use
+        key = territory_name, sector_name
+        if key not in self.cells:
+            self.cells[key] = Cell(self.cellPolygon(territory_name, sector_name))
+        return self.cells[key]
+
+    def placedTokens(self, game_state, territory_name, sector_name):
+        placed = []
+        for token_name, element_object in game_state['visual'].get(territory_name, {}).get(sector_name, {}).items():
+            placed.append((element_object['x'], element_object['y'], self.manager.getRadius(token_name)))
+        return placed
+
+    def prepareInstance(self, game_state, territory_name, sector_name):
+        cell = self.cell(territory_name, sector_name)
         if territory_name not in game_state['visual'].keys():
             game_state['visual'][territory_name] = {}
         if sector_name not in game_state['visual'][territory_name].keys():
             game_state['visual'][territory_name][sector_name] = {}
-        for token_name in game_state['visual'][territory_name][sector_name].keys():
-            element_object = game_state['visual'][territory_name][sector_name][token_name]
-            x = element_object['x']
-            y = element_object['y']
-            radius = self.manager.getRadius(token_name)
-            polygon_token = Point(x, y).buffer(radius)
-            avoid_overlap_territories.append(polygon_token)
-        return polygons_maximize_overlap, avoid_overlap_territories
-
+        # tokens already in the sector are avoided as exact circles
+        avoid_overlap_territories = self.placedTokens(game_state, territory_name, sector_name)
+        return cell, avoid_overlap_territories
+
+
+    def findFreeSlots(self, game_state, territory_name, sector_name, radii):
+        # assigns the precomputed slots in order, None once a token finds no free slot
+        placed = self.placedTokens(game_state, territory_name, sector_name)
+        state = []
+        for radius in radii:
+            for x, y in self.manager.getSlots(territory_name, sector_name, radius):
+                if all((x-px)**2+(y-py)**2 >= (radius+pr)**2 for px, py, pr in placed):
+                    break
+            else:
+                return None
+            placed.append((x, y, radius))
+            state += [x, y]
+        return state
+
+    def search(self, problem, territory_name, sector_name, kind):
+        # returns the state of a solved placement, remembered across games,
+        # kind is 'single' or 'multiple' after the problem
+        key = None
+        if self.placements is not None:
+            key = placementKey(territory_name, sector_name, problem.radii, problem.avoid_circles, self.engine)
+            state = self.placements.get(key)
+            if state is not None:
+                return problem.stateOf(np.reshape(state, (-1, 2)))
+        budget = None
+        if self.deadline is not None:
+            budget = max(self.deadline-time.perf_counter(), 0)
+        options = self.game_config.get('placement', {}).get('options', {}).get(self.engine, {})
+        # solvers may be tuned apart for single and multiple token problems
+        if 'single' in options or 'multiple' in options:
+            options = options.get(kind, {})
+        result = solve(self.engine, problem, budget=budget, **options)
+        self.evaluations += result.evaluations
+        self.violation += float(result.violation)
+        # placements cut short by the budget are not worth remembering
+        if key is not None and result.reason != 'budget':
+            self.placements.put(key, np.ravel(result.state))
+        return result.state
 
     def placeSingleToken(self, game_state, territory_name, sector_name, element_name, tolerance=0.01, amount=0):
         target_radius = self.manager.getRadius(element_name)
-        polygons_maximize_overlap, avoid_overlap_territories = self.prepareInstance(game_state, territory_name, sector_name)
-        problem = TokenPlacementProblem(polygons_maximize_overlap, avoid_overlap_territories, target_radius, tolerance=0.01)
-        result = genetic(problem, population_size=75, mutation_chance=0.15, iterations_limit=120)
-        x, y = result.state
+        state = self.findFreeSlots(game_state, territory_name, sector_name, [target_radius])
+        if state is None:
+            cell, avoid_overlap_territories = self.prepareInstance(game_state, territory_name, sector_name)
+            problem = TokenPlacementProblem(cell, avoid_overlap_territories, target_radius, tolerance=0.01)
+            with self.profiler.stage('placeSingleToken'):
+                state = self.search(problem, territory_name, sector_name, 'single')
+        x, y = state
         token_type = 'leader_like'
         if self.manager.isLeader(element_name):
             token_type = 'leader'
         if self.manager.isTroop(element_name):
             token_type = 'troop_token'
-        game_state['visual'][territory_name][sector_name][element_name] = {
+        game_state['visual'].setdefault(territory_name, {}).setdefault(sector_name, {})[element_name] = {
             'token': element_name,
             'type': token_type,
             'x': x,
             'y': y,
             'c': amount
         }
-        return result.state
+        return tuple(state)
 
 
     def placeMultipleTokens(self, game_state, territory_name, sector_name, names, amounts):
         target_radii = [self.manager.getRadius(name) for name in names]
-        polygons_maximize_overlap, avoid_overlap_territories = self.prepareInstance(game_state, territory_name, sector_name)
-        problem = MultiTokenPlacementProblem(polygons_maximize_overlap, avoid_overlap_territories, target_radii, tolerance=0.01)
-        result = genetic(problem, population_size=75, mutation_chance=0.2, iterations_limit=100)
+        state = self.findFreeSlots(game_state, territory_name, sector_name, target_radii)
+        if state is None:
+            cell, avoid_overlap_territories = self.prepareInstance(game_state, territory_name, sector_name)
+            problem = MultiTokenPlacementProblem(cell, avoid_overlap_territories, target_radii, tolerance=0.01)
+            with self.profiler.stage('placeMultipleTokens'):
+                state = self.search(problem, territory_name, sector_name, 'multiple')
         for i, (name, amount) in enumerate(zip(names, amounts)):
-            x = result.state[i*2]
-            y = result.state[i*2+1]
+            x = state[i*2]
+            y = state[i*2+1]
             token_type = 'leader_like'
             # print('multiplace')
             # print(name)
@@ -475,35 +562,38 @@ class RenderingProcessor:
                 token_type = 'leader_token'
             elif self.manager.isTroop(name):
                 token_type = 'troop_token'
-            game_state['visual'][territory_name][sector_name][name] = {
+            game_state['visual'].setdefault(territory_name, {}).setdefault(sector_name, {})[name] = {
                 'token': name,
                 'type': token_type,
                 'x': x,
                 'y': y,
                 'c': amount
             }
-        return result.state
+        return state
 
     def calculateStormPosition(self, position):
-        cx, cy, cr = self.manager.getCenter()
-        angle = (position-6.5)*360/18
-        angle_rot = angle - 90
-        angle_rad = 2*math.pi*(-angle)/360
-        x = cx+math.cos(angle_rad)*cr
-        y = cy+math.sin(angle_rad)*cr
-        storm_object = {
-            'token': self.manager.getFile('storm'),
-            'x': x,
-            'y': y,
-            's': 0.5,
-            'a': angle_rot,
-        }
-        return storm_object
+        return stormObject(self.manager.getCenter(), position, self.manager.getFile('storm'))
 
     def calculateWheel(self, value):
-        return 360*(value+1.25)/21
+        return wheelAngle(value)
+
+    async def process_async(self, game_state, executor=None):
+        # processes a copy of the state in the executor, the argument is left
+        # as is, the searches run on a copy of the processor with their own
+        # deadline and counts, added here once the processing is done
+        loop = asyncio.get_running_loop()
+        snapshot = json.loads(json.dumps(game_state))
+        worker = copy.copy(self)
+        worker.profiler = NULL_PROFILER
+        worker.evaluations = 0
+        worker.violation = 0.0
+        processed = await loop.run_in_executor(executor, worker.process, snapshot)
+        self.evaluations += worker.evaluations
+        self.violation += worker.violation
+        return processed
 
     def process(self, game_state):
+        self.deadline = None if self.budget is None else time.perf_counter()+self.budget
         # find objects which should be rendered but have no coordinates
         to_place = {}
         for territory in self.manager.getAreas():
@@ -656,6 +746,10 @@ class OriginatorTruthsayer(OriginatorJSON):
     def __init__(self, game_state={}, meta={}):
         self.processor = RenderingProcessor()
         self.cards_manager = CardsManager()
+        # last rendered frame per render scale, successive renders only
+        # repaint what changed
+        self.previous_frames = {}
+        self._render_task = None
         if game_state == {}:
             game_state = self.initiate(meta)
         super().__init__(game_state)
@@ -861,7 +955,7 @@ class OriginatorTruthsayer(OriginatorJSON):
         target_territory_spice = target_territory + '_spice'
         if not self.processor.manager.isAreaSpice(target_territory_spice):
             raise ValueError('Invalid target territory')
-        if target_territory not in self._object_state['territories'].keys():
+        if target_territory_spice not in self._object_state['territories'].keys():
             self._object_state['territories'][target_territory_spice] = 0
         self._object_state['territories'][target_territory_spice] += N
         cmd = '/{0} {1} {2}'.format('spiceblow', target_territory, str(N))
@@ -1354,12 +1448,159 @@ class OriginatorTruthsayer(OriginatorJSON):
         }
         return _object_state
 
-    def render(self, outfile, battle=False):
+    def warmCardFaces(self, card_ids=None):
+        renderer = Renderer(
+            self._object_state,
+            self.processor.game_config,
+            self.cards_manager.card_objects,
+            None)
+        renderer.warmCardFaces(card_ids)
+
+    def renderFrame(self, battle=False, incremental=True, scale=1.0):
+       # renders the board without encoding it, returns the frame
        self._object_state = self.processor.process(self._object_state)
-       renderer = Renderer(
-           self._object_state,
+       return self.drawFrame(battle=battle, incremental=incremental, scale=scale)
+
+    def drawFrame(self, battle=False, incremental=True, scale=1.0, game_state=None, profiler=None, keep=True):
+       # renders the already processed state, keep makes the frame the one
+       # the next incremental render starts from
+       if game_state is None:
+           game_state = self._object_state
+       renderer = self.makeRenderer(game_state, battle, incremental, scale, profiler)
+       frame = renderer.render()
+       if keep:
+           self.previous_frames[scale] = frame
+       return frame
+
+    def makeRenderer(self, game_state, battle=False, incremental=True, scale=1.0, profiler=None):
+       previous = self.previous_frames.get(scale, None) if incremental else None
+       return Renderer(
+           game_state,
            self.processor.game_config,
            self.cards_manager.card_objects,
-           outfile,
-           battle=battle)
-       renderer.render()
+           None,
+           battle=battle,
+           previous=previous,
+           scale=scale,
+           profiler=profiler)
+
+    def renderViews(self, factions=None, battle=False, incremental=True, format='jpeg', quality=95, optimize=False, progressive=False, max_bytes=None, scale=1.0):
+       # the public board and the private view of each faction from a single
+       # processed state and board render, returns encoded images keyed by
+       # 'public' and the faction names
+       self._object_state = self.processor.process(self._object_state)
+       if factions is None:
+           factions = list(self._object_state['meta']['factions'].values())
+       renderer = self.makeRenderer(self._object_state, battle, incremental, scale)
+       frame = renderer.render()
+       self.previous_frames[scale] = frame
+       hands = {faction: self.hand(faction) for faction in factions}
+       views = renderer.renderViews(frame['image'], hands)
+       return {
+           view: encode(image, format=format, quality=quality, optimize=optimize, progressive=progressive, max_bytes=max_bytes)
+           for view, image in views.items()}
+
+    def render(self, outfile=None, battle=False, incremental=True, format=None, quality=95, optimize=False, progressive=False, max_bytes=None, scale=1.0, cache=True, profiler=None):
+       # returns the encoded image, it is also written out if outfile
+       # is a path or a writable file object, pass a Profiler to get the
+       # time and memory spent in every stage
+       profiler = profiler if profiler is not None else NULL_PROFILER
+       self.processor.profiler = profiler
+       try:
+           with profiler.stage('process'):
+               self._object_state = self.processor.process(self._object_state)
+       finally:
+           self.processor.profiler = NULL_PROFILER
+       return self.renderState(self._object_state, outfile, battle, incremental, format, quality, optimize, progressive, max_bytes, scale, cache, profiler)
+
+    def renderState(self, game_state, outfile=None, battle=False, incremental=True, format=None, quality=95, optimize=False, progressive=False, max_bytes=None, scale=1.0, cache=True, profiler=None):
+       # renders and encodes an already processed state
+       profiler = profiler if profiler is not None else NULL_PROFILER
+       if format is None:
+           format = formatOf(outfile)
+       # identical inputs give identical bytes, repeated renders are served
+       # from the results cache
+       with profiler.stage('digest'):
+           key = renderDigest(
+               game_state,
+               battle=battle,
+               scale=scale,
+               format=format.lower(),
+               quality=quality,
+               optimize=optimize,
+               progressive=progressive,
+               max_bytes=max_bytes)
+       result = render_results.get(key) if cache else None
+       if result is not None:
+           if outfile is not None:
+               result.save(outfile)
+           return result
+       with profiler.stage('render'):
+           frame = self.drawFrame(battle=battle, incremental=incremental, scale=scale, game_state=game_state, profiler=profiler)
+       with profiler.stage('encode'):
+           result = encode(
+               frame['image'],
+               format=format,
+               quality=quality,
+               optimize=optimize,
+               progressive=progressive,
+               max_bytes=max_bytes)
+       if cache:
+           render_results.put(key, result)
+       if outfile is not None:
+           with profiler.stage('save'):
+               result.save(outfile)
+       return result
+
+    async def process_async(self, executor=None):
+       # token placement runs on a snapshot in the executor, commands keep
+       # mutating the live state meanwhile, only the placements are written
+       # back, as a copy since the processed state is rendered in the executor
+       processed = await self.processor.process_async(self._object_state, executor)
+       self._object_state['visual'] = json.loads(json.dumps(processed['visual']))
+       return processed
+
+    async def render_async(self, outfile=None, battle=False, incremental=True, format=None, quality=95, optimize=False, progressive=False, max_bytes=None, scale=1.0, cache=True, executor=None):
+       # a newer render of this game cancels the one still in progress, its
+       # caller gets asyncio.CancelledError
+       if self._render_task is not None and not self._render_task.done():
+           self._render_task.cancel()
+       options = outfile, battle, incremental, format, quality, optimize, progressive, max_bytes, scale, cache
+       self._render_task = asyncio.ensure_future(self.renderPipeline(executor, options))
+       return await self._render_task
+
+    async def renderPipeline(self, executor, options):
+       # processing, drawing and encoding are separate executor jobs, a
+       # cancelled render stops before the next one starts and its frame
+       # never becomes the previous one
+       outfile, battle, incremental, format, quality, optimize, progressive, max_bytes, scale, cache = options
+       if format is None:
+           format = formatOf(outfile)
+       processed = await self.process_async(executor)
+       loop = asyncio.get_running_loop()
+       key = renderDigest(
+           processed,
+           battle=battle,
+           scale=scale,
+           format=format.lower(),
+           quality=quality,
+           optimize=optimize,
+           progressive=progressive,
+           max_bytes=max_bytes)
+       result = render_results.get(key) if cache else None
+       if result is None:
+           frame = await loop.run_in_executor(executor, functools.partial(self.drawFrame, battle=battle, incremental=incremental, scale=scale, game_state=processed, keep=False))
+           self.previous_frames[scale] = frame
+           result = await loop.run_in_executor(executor, functools.partial(
+               encode,
+               frame['image'],
+               format=format,
+               quality=quality,
+               optimize=optimize,
+               progressive=progressive,
+               max_bytes=max_bytes))
+           if cache:
+               render_results.put(key, result)
+       if outfile is not None:
+           result.save(outfile)
+       return result
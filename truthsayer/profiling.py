@@ -0,0 +1,93 @@
+import time
+import tracemalloc
+
+from contextlib import contextmanager
+
+
+# stand-in used when profiling is off
+class NullProfiler:
+    @contextmanager
+    def stage(self, name):
+        yield self
+
+
+# wall time, CPU time and peak allocation of named stages, repeated stages
+# are aggregated, tracemalloc slows the code down and misses the Pillow
+# buffers, memory=False only records timings
+class Profiler:
+    def __init__(self, memory=True, sink=None):
+        self.memory = memory
+        self.sink = sink
+        self.stages = {}
+        self.order = []
+        self._stack = []
+
+    def tracedPeak(self):
+        _, peak = tracemalloc.get_traced_memory()
+        return peak
+
+    @contextmanager
+    def stage(self, name):
+        entry = {'base': 0, 'peak': 0, 'started': False}
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                entry['started'] = True
+            # the enclosing stage keeps the peak it reached so far
+            peak = self.tracedPeak()
+            for parent in self._stack:
+                parent['peak'] = max(parent['peak'], peak-parent['base'])
+            tracemalloc.reset_peak()
+            entry['base'], _ = tracemalloc.get_traced_memory()
+        self._stack.append(entry)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield self
+        finally:
+            wall = time.perf_counter()-wall
+            cpu = time.process_time()-cpu
+            self._stack.pop()
+            if self.memory:
+                peak = self.tracedPeak()
+                entry['peak'] = max(entry['peak'], peak-entry['base'])
+                for parent in self._stack:
+                    parent['peak'] = max(parent['peak'], peak-parent['base'])
+                tracemalloc.reset_peak()
+            self.record(name, wall, cpu, entry['peak'] if self.memory else None, len(self._stack))
+            if entry['started']:
+                tracemalloc.stop()
+
+    def record(self, name, wall, cpu, peak=None, depth=0):
+        if name not in self.stages:
+            self.stages[name] = {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'peak': peak, 'depth': depth}
+            self.order.append(name)
+        metrics = self.stages[name]
+        metrics['calls'] += 1
+        metrics['wall'] += wall
+        metrics['cpu'] += cpu
+        if peak is not None:
+            metrics['peak'] = max(metrics['peak'] or 0, peak)
+
+    def report(self):
+        # nested stages are already part of the time of their parents
+        top = [name for name in self.order if self.stages[name]['depth'] == 0]
+        return {
+            'stages': [dict(self.stages[name], stage=name) for name in self.order],
+            'wall': sum(self.stages[name]['wall'] for name in top),
+            'cpu': sum(self.stages[name]['cpu'] for name in top)
+        }
+
+    def publish(self, sink=None):
+        sink = sink if sink is not None else self.sink
+        if sink is None:
+            return None
+        for name in self.order:
+            sink(name, dict(self.stages[name]))
+
+    def reset(self):
+        self.stages = {}
+        self.order = []
+
+
+NULL_PROFILER = NullProfiler()
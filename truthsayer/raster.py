@@ -0,0 +1,62 @@
+import shapely
+import numpy as np
+
+from truthsayer.cache import LRUCache
+
+
+def distanceTransform(mask, chunk=32):
+    # exact separable euclidean distance to the nearest zero pixel, chunk rows
+    # at a time, the mask should have zero pixels on its border
+    height, width = mask.shape
+    rows = np.arange(height, dtype=float)[:, None]
+    zero = mask == 0
+    above = np.maximum.accumulate(np.where(zero, rows, -np.inf), axis=0)
+    below = np.flip(np.minimum.accumulate(np.flip(np.where(zero, rows, np.inf), axis=0), axis=0), axis=0)
+    vertical = np.minimum(rows-above, below-rows)**2
+    columns = np.arange(width, dtype=float)
+    shift = (columns[:, None]-columns[None, :])**2
+    distances = np.empty((height, width))
+    for start in range(0, height, chunk):
+        block = vertical[start:start+chunk]
+        distances[start:start+chunk] = np.min(block[:, None, :]+shift[None, :, :], axis=2)
+    return np.sqrt(distances)
+
+
+# cells are rasterized once, each token goes to the pixel furthest from the
+# border and the other tokens, the largest first, results are deterministic
+class RasterPlacer:
+    def __init__(self, step=2, max_bytes=32*2**20):
+        self.step = step
+        self.masks = LRUCache(max_bytes, weigh=lambda mask: sum(array.nbytes for array in mask))
+
+    def raster(self, key, polygon):
+        return self.masks.fetch(key, lambda: self.rasterize(polygon))
+
+    def rasterize(self, polygon):
+        minx, miny, maxx, maxy = polygon.bounds
+        # one pixel of margin keeps the border of the mask empty
+        xs = np.arange(minx-self.step, maxx+2*self.step, self.step)
+        ys = np.arange(miny-self.step, maxy+2*self.step, self.step)
+        gx, gy = np.meshgrid(xs, ys)
+        return gx, gy, shapely.contains_xy(polygon, gx, gy)
+
+    def place(self, key, polygon, placed, radii):
+        # placed lists the (x, y, radius) of the tokens already in the cell
+        gx, gy, inside = self.raster(key, polygon)
+        mask = inside.copy()
+        for x, y, radius in placed:
+            mask &= (gx-x)**2+(gy-y)**2 > radius**2
+        centers = {}
+        for j in sorted(range(len(radii)), key=lambda j: -radii[j]):
+            clearance = distanceTransform(mask)
+            if not mask.any():
+                # the cell is full, the token goes to its deepest point
+                clearance = distanceTransform(inside)
+            row, column = np.unravel_index(np.argmax(clearance), clearance.shape)
+            x, y = float(gx[row, column]), float(gy[row, column])
+            centers[j] = x, y
+            mask &= (gx-x)**2+(gy-y)**2 > radii[j]**2
+        state = []
+        for j in range(len(radii)):
+            state += list(centers[j])
+        return state
@@ -4,6 +4,7 @@ import textwrap
 import qrcode
 import math
 import json
+import copy
 
 try:
     import importlib.resources as pkg_resources
@@ -13,6 +14,50 @@ except ImportError:
 
 from truthsayer import assets
 from truthsayer.assets import json_files
+from truthsayer.sprites import sprites, imageWeight
+from truthsayer.fonts import fonts
+from truthsayer.cache import LRUCache
+from truthsayer.atlas import getWheelAtlas, getStormAtlas, stormCenter
+from truthsayer.profiling import NULL_PROFILER
+
+
+RENDERER_FONTS = [
+    ('FreeSans.ttf', 15),
+    ('FreeSans.ttf', 27),
+    ('FreeSans.ttf', 24),
+    ('FreeSans.ttf', 19),
+    ('FreeSans.ttf', 13),
+    ('RobotoCondensed-Bold.ttf', 22)
+]
+
+
+# static layers shared by all the renders with the same map and promo texts
+base_layers = LRUCache(8)
+# rendered card faces keyed by (card id, background, unit size, scale)
+card_faces = LRUCache(64*2**20, weigh=imageWeight)
+# anti-aliased troop discs per troop type and their count labels
+troop_sprites = LRUCache(16*2**20, weigh=lambda entry: imageWeight(entry[0] if type(entry) is tuple else entry))
+
+TROOP_COLORS = {
+    'spiritual_advisor': '#274587',
+    'bene_gesserit_troops': '#274587',
+    'atreides_troops': '#306C3D',
+    'harkonnen_troops': '#000000',
+    'emperor_troops': '#ED3337',
+    'sardaukar': '#ED3337',
+    'spacing_guild_troops': '#E8552C',
+    'fremen_troops': '#FEC64B',
+    'fedaykin': '#FEC64B'
+}
+TROOP_SPECIAL = ['spiritual_advisor', 'sardaukar', 'fedaykin']
+# background of the private hand strip, the dark red of the map border
+HAND_BACKGROUND = (98, 32, 34, 255)
+# no faction ever has more troop tokens than that
+TROOP_MAX_COUNT = 20
+
+
+def warmFonts():
+    fonts.warm(RENDERER_FONTS)
 
 
 def makeQR(data, box_size=4, border=4):
@@ -29,19 +74,22 @@ def makeQR(data, box_size=4, border=4):
 
 
 class Renderer:
-    def __init__(self, game_state, game_config, card_objects, outfile, troop_tokens=[], dead_leaders=[], quality=95, battle=False):
+    def __init__(self, game_state, game_config, card_objects, outfile, troop_tokens=[], dead_leaders=[], quality=95, battle=False, previous=None, scale=1.0, profiler=None):
         self.deck_generator = json.loads(pkg_resources.read_text(json_files, 'generated_decks.json'))
-        self.txt_spacing_wheel = 5
+        # previews are drawn directly at a fraction of the map resolution
+        self.scale = scale
+        self.profiler = profiler if profiler is not None else NULL_PROFILER
+        self.txt_spacing_wheel = self.px(5)
         self.card_unit = 8
-        self.card_radius = 10
-        self.card_spacing = 10
-        self.game_state = game_state
+        self.card_radius = self.px(10)
+        self.card_spacing = self.px(10)
+        self.game_state = self.scaleState(game_state)
         self.game_config = game_config
         self.card_objects = card_objects
         self.battle = battle
-        self.troop_edge = game_config['dimensions']['troop_edge']
-        self.troop_size = game_config['dimensions']['troop']
-        self.leader_size = game_config['dimensions']['leader']
+        self.troop_edge = max(1, self.px(game_config['dimensions']['troop_edge']))
+        self.troop_size = self.tokenSize(game_config['dimensions']['troop'])
+        self.leader_size = self.tokenSize(game_config['dimensions']['leader'])
         self.spice_size = game_config['dimensions']['spice']
         self.factions = game_state['meta']['factions']
         self.texts = game_state['meta']['texts']
@@ -49,77 +97,179 @@ class Renderer:
         self.troop_tokens = troop_tokens # TODO
         self.outfile = outfile
         self.quality = quality
+        self.sprites = sprites
+        # frame of the previous render of the same game, if any
+        self.previous = previous
+        self.dirty = None
+        self.frame = None
         # prepare canvas
         self.prepareCanvas()
         # prepare data
         self.factions_positions = self.calculateFactionLeadersPositions()
 
+    def px(self, value):
+        # board pixel constant at the render scale
+        if self.scale == 1:
+            return value
+        return int(round(value*self.scale))
+
+    def tokenSize(self, value):
+        # tokens are pasted around their center, keep scaled sizes even
+        if self.scale == 1:
+            return value
+        return max(2, 2*int(round(value*self.scale/2)))
+
+    def scaleState(self, game_state):
+        # shallow copy of the state with the token coordinates scaled, the
+        # original state is never modified
+        if self.scale == 1:
+            return game_state
+        visual = {}
+        for territory_name, entry in game_state['visual'].items():
+            if territory_name == 'storm':
+                entry = dict(entry)
+                for key in ['x', 'y', 's']:
+                    entry[key] *= self.scale
+            elif type(entry) is dict and not territory_name.startswith('wheel_'):
+                entry = {
+                    sector_name: {
+                        token_name: dict(token_instance, x=token_instance['x']*self.scale, y=token_instance['y']*self.scale)
+                        for token_name, token_instance in token_object.items()}
+                    for sector_name, token_object in entry.items()}
+            visual[territory_name] = entry
+        return dict(game_state, visual=visual)
+
+    def circle(self, territory_name):
+        x, y = self.game_config['generated']['territories']['circles'][territory_name]
+        return self.px(x), self.px(y)
+
+    def getFont(self, filename, size):
+        return fonts.get(filename, max(1, self.px(size)))
+
+    def spiceSize(self):
+        params = self.game_state['configs'].get('spice_token', ['czempak_spice_1', None])
+        size = params[1]
+        if size is None:
+            size = self.spice_size
+        return params[0], self.tokenSize(size)
+
     def prepareCanvas(self):
-        filename = pkg_resources.open_binary(assets, 'map.png')
-        self.canvas = Image.open(filename)
-        self.canvas = self.canvas.convert('RGBA')
+        self.fnt = self.getFont('FreeSans.ttf', 15)
+        self.fnt_wheel = self.getFont('FreeSans.ttf', 27)
+        self.fnt_card_large = self.getFont('FreeSans.ttf', 24)
+        self.fnt_card_small = self.getFont('FreeSans.ttf', 19)
+        self.fnt_card_tiny = self.getFont('FreeSans.ttf', 13)
+        self.fnt_troop = self.getFont('RobotoCondensed-Bold.ttf', 22)
+        key = (
+            'map.png',
+            self.scale,
+            self.texts.get('qr', None),
+            self.texts.get('promo', None),
+            self.texts.get('promo_top', None))
+        with self.profiler.stage('baseLayer'):
+            self.base = base_layers.fetch(key, self.buildBaseLayer)
+        self.canvas = self.base['map'].copy()
         self.width_canvas, self.height_canvas = self.canvas.size
-        del filename
-        # text layer
-        self.txt = Image.new('RGBA', self.canvas.size, (255,255,255,0))
+        # text layer, starts with the sector markings already drawn
+        self.txt = self.base['labels'].copy()
         self.d = ImageDraw.Draw(self.txt)
-        filename = pkg_resources.open_binary(assets, 'FreeSans.ttf')
-        self.fnt = ImageFont.truetype(filename, 15)
-        del filename
-        filename = pkg_resources.open_binary(assets, 'FreeSans.ttf')
-        self.fnt_wheel = ImageFont.truetype(filename, 27)
-        del filename
-        filename = pkg_resources.open_binary(assets, 'FreeSans.ttf')
-        self.fnt_card_large = ImageFont.truetype(filename, 24)
-        del filename
-        filename = pkg_resources.open_binary(assets, 'FreeSans.ttf')
-        self.fnt_card_small = ImageFont.truetype(filename, 19)
-        del filename
-        filename = pkg_resources.open_binary(assets, 'FreeSans.ttf')
-        self.fnt_card_tiny = ImageFont.truetype(filename, 13)
-        del filename
-        filename = pkg_resources.open_binary(assets, 'RobotoCondensed-Bold.ttf')
-        self.fnt_troop = ImageFont.truetype(filename, 22)
-        del filename
 
-    # for text use self.d making sure text is on top of all the tokens
-    # for drawing tokens use d that would ensure they are under the spiceglow
-    def renderTroop(self, d, x, y, faction, number):
-        colors = {
-            'spiritual_advisor': '#274587',
-            'bene_gesserit_troops': '#274587',
-            'atreides_troops': '#306C3D',
-            'harkonnen_troops': '#000000',
-            'emperor_troops': '#ED3337',
-            'sardaukar': '#ED3337',
-            'spacing_guild_troops': '#E8552C',
-            'fremen_troops': '#FEC64B',
-            'fedaykin': '#FEC64B'
+    def buildBaseLayer(self):
+        filename = pkg_resources.open_binary(assets, 'map.png')
+        canvas = Image.open(filename)
+        canvas = canvas.convert('RGBA')
+        del filename
+        if self.scale != 1:
+            width, height = canvas.size
+            canvas = canvas.resize((self.px(width), self.px(height)), Image.ANTIALIAS)
+        self.width_canvas, self.height_canvas = canvas.size
+        labels = Image.new('RGBA', canvas.size, (255,255,255,0))
+        with self.profiler.stage('renderRegionMarks'):
+            self.renderRegionMarks(ImageDraw.Draw(labels))
+        # QR code and promo texts end up on top of everything else
+        overlay = Image.new('RGBA', canvas.size, (255,255,255,0))
+        with self.profiler.stage('renderQR'):
+            overlay = self.renderQR(overlay)
+        overlay_box = overlay.getbbox()
+        if overlay_box is not None:
+            overlay = overlay.crop(overlay_box)
+        return {
+            'map': canvas,
+            'labels': labels,
+            'overlay': overlay,
+            'overlay_box': overlay_box
         }
-        fill = colors.get(faction, 'blue')
-        box = (
-            x-self.troop_size/2,
-            y-self.troop_size/2,
-            x+self.troop_size/2,
-            y+self.troop_size/2)
-        d.ellipse(box, fill=fill, outline ='black', width=2)
-        text_fill = 'white'
-        if faction in ['spiritual_advisor', 'sardaukar', 'fedaykin']:
-            text_fill = 'black'
-            box = (
-                x-self.troop_size/2+self.troop_edge,
-                y-self.troop_size/2+self.troop_edge,
-                x+self.troop_size/2-self.troop_edge,
-                y+self.troop_size/2-self.troop_edge)
-            d.ellipse(box, fill='white', outline ='black', width=2)
-        text = str(number)
+
+    # for text use self.txt making sure text is on top of all the tokens
+    # for drawing tokens use layer that would ensure they are under the spiceglow
+    def renderTroop(self, layer, x, y, faction, number):
+        # the disc sprite has a pixel of margin around the token
+        half = (self.troop_size+2)/2
+        if not self.isDirty((x-half, y-half, x+half, y+half)):
+            return None
+        disc, label, (dx, dy) = self.troopSprite(faction, number)
+        self.pasteSprite(layer, disc, x-half, y-half)
+        self.pasteSprite(self.txt, label, x+dx, y+dy)
+
+    def troopSprite(self, faction, number):
+        disc_key = 'disc', faction, self.troop_size, self.troop_edge, self.scale
+        disc = troop_sprites.fetch(disc_key, lambda: self.drawTroopDisc(faction))
+        text_fill = 'black' if faction in TROOP_SPECIAL else 'white'
+        label_key = 'label', str(number), text_fill, self.fnt_troop.size
+        label, offset = troop_sprites.fetch(label_key, lambda: self.drawTroopLabel(str(number), text_fill))
+        return disc, label, offset
+
+    def warmTroopSprites(self):
+        for faction in TROOP_COLORS.keys():
+            for number in range(1, TROOP_MAX_COUNT+1):
+                self.troopSprite(faction, number)
+
+    def warmAtlases(self, storm_object):
+        # the battle wheels are a third of the board wide
+        self.stormSprite(storm_object)
+        getWheelAtlas(int(self.width_canvas/3))
+
+    def drawTroopDisc(self, faction):
+        # drawn four times larger and downsampled to get smooth edges
+        supersample = 4
+        size = self.troop_size+2
+        outline = supersample*max(1, self.px(2))
+        disc = Image.new('RGBA', (supersample*size, supersample*size), (255,255,255,0))
+        d = ImageDraw.Draw(disc)
+        c = supersample*size/2
+        r = supersample*self.troop_size/2
+        fill = TROOP_COLORS.get(faction, 'blue')
+        d.ellipse((c-r, c-r, c+r, c+r), fill=fill, outline='black', width=outline)
+        if faction in TROOP_SPECIAL:
+            r -= supersample*self.troop_edge
+            d.ellipse((c-r, c-r, c+r, c+r), fill='white', outline='black', width=outline)
+        return disc.resize((size, size), Image.LANCZOS)
+
+    def drawTroopLabel(self, text, text_fill):
+        # the label is anchored like the count used to be drawn on the token
         w, h = self.fnt_troop.getsize(text)
-        self.d.text((x, y+h/2-2), text, font=self.fnt_troop, fill=text_fill, anchor='ms')
+        ax, ay = 0, h/2-2
+        left, top, right, bottom = ImageDraw.Draw(self.txt).textbbox((ax, ay), text, font=self.fnt_troop, anchor='ms')
+        left, top = int(math.floor(left)), int(math.floor(top))
+        right, bottom = int(math.ceil(right)), int(math.ceil(bottom))
+        label = Image.new('RGBA', (right-left, bottom-top), (255,255,255,0))
+        ImageDraw.Draw(label).text((ax-left, ay-top), text, font=self.fnt_troop, fill=text_fill, anchor='ms')
+        return label, (left, top)
+
+    def pasteSprite(self, layer, sprite, x, y):
+        # alpha composites the sprite with its top left corner at (x, y)
+        x, y = int(round(x)), int(round(y))
+        width, height = sprite.size
+        left, top = max(x, 0), max(y, 0)
+        right = min(x+width, layer.size[0])
+        bottom = min(y+height, layer.size[1])
+        if right <= left or bottom <= top:
+            return None
+        layer.alpha_composite(sprite, (left, top), (left-x, top-y, right-x, bottom-y))
 
     def renderTroops(self):
         # troop token layer
         layer = Image.new('RGBA', self.canvas.size, (255,255,255,0))
-        d = ImageDraw.Draw(layer)
         # handle the generation
         territorys = self.game_config['generated']['territories']['polygons']
         type_point = self.game_config['types']['territories']['point']
@@ -153,16 +303,16 @@ class Renderer:
                         number = token_instance['c']
                         if number == 0:
                             continue
-                        self.renderTroop(d, x, y, faction, number)
+                        self.renderTroop(layer, x, y, faction, number)
         # compose the tokens layer
-        self.canvas = Image.alpha_composite(self.canvas, layer)
+        self.compositeLayer(layer)
 
     def calculateFactionLeadersPositions(self):
         positions = []
         for i in range(18):
-            self.leader_r = int((self.width_canvas/2)-50)
+            self.leader_r = int((self.width_canvas/2)-self.px(50))
             if i in [1, 2, 4, 5]:
-                self.leader_r += 20
+                self.leader_r += self.px(20)
             reg = 2*math.pi/18
             angle = (-3*i+4)*reg+reg/2
             dx = int(self.leader_r*math.cos(angle))
@@ -172,40 +322,47 @@ class Renderer:
             positions.append(tuple([x, y]))
         return positions
 
-    def renderQR(self):
+    def renderQR(self, canvas):
         if self.texts.get('qr', None) is None:
-            return None
-        qr_code = makeQR(self.texts['qr'])
+            return canvas
+        qr_code = makeQR(self.texts['qr'], box_size=max(1, self.px(4)))
         self.width_qr, self.height_qr = qr_code.size
-        self.pos_qr_x = int(self.width_canvas-self.width_qr-20)
-        self.pos_qr_y = int(self.height_canvas - self.height_qr - 40)
-        self.canvas.paste(qr_code, (self.pos_qr_x, self.pos_qr_y))
+        self.pos_qr_x = int(self.width_canvas-self.width_qr-self.px(20))
+        self.pos_qr_y = int(self.height_canvas - self.height_qr - self.px(40))
+        canvas.paste(qr_code, (self.pos_qr_x, self.pos_qr_y))
 
         w, h = self.fnt.getsize(self.texts['promo'])
         w2, h2 = self.fnt.getsize(self.texts['qr'])
         if w2 > w:
             w = w2
-        x = int(self.width_canvas-w-20)
-        y = self.height_canvas - 40
+        x = int(self.width_canvas-w-self.px(20))
+        y = self.height_canvas - self.px(40)
         text = self.texts['promo'] + '\n' + self.texts['qr']
-        self.canvas, w, h = self.renderText(text, self.fnt, 'white', x, y, anchor=None)
+        canvas, w, h = self.renderText(text, self.fnt, 'white', x, y, anchor=None, canvas=canvas)
 
         text = self.texts['promo_top']
         w, h = self.fnt.getsize(text)
-        x = int(self.width_canvas-w-20)
-        y = self.height_canvas - self.height_qr - 40 - 20
-        self.canvas, w, h = self.renderText(text, self.fnt, 'white', x, y, anchor=None)
+        x = int(self.width_canvas-w-self.px(20))
+        y = self.height_canvas - self.height_qr - self.px(40) - self.px(20)
+        canvas, w, h = self.renderText(text, self.fnt, 'white', x, y, anchor=None, canvas=canvas)
+        return canvas
+
+    def placeOverlay(self):
+        overlay_box = self.base['overlay_box']
+        if overlay_box is None:
+            return None
+        self.canvas.alpha_composite(self.base['overlay'], overlay_box[:2])
 
-    def renderRegionMarks(self):
+    def renderRegionMarks(self, d):
         # sector markings
         for i in range(18):
             color = 'black'
-            r = int((self.width_canvas/2)-70)
+            r = int((self.width_canvas/2)-self.px(70))
             if i not in [12, 13]:
-                r += 40
+                r += self.px(40)
                 color = 'white'
             if 6 < i < 16:
-                r -= 10
+                r -= self.px(10)
             reg = 2*math.pi/18
             angle = (-i+5)*reg
             if i in [2, 4, 10, 13]:
@@ -214,9 +371,9 @@ class Renderer:
                 angle += 6*reg/7
             dx = int(r*math.cos(angle))
             dy = int(r*math.sin(angle))
-            x = int(self.width_canvas/2)+dx-4
+            x = int(self.width_canvas/2)+dx-self.px(4)
             y = int(self.height_canvas/2)+dy
-            self.d.text((x, y), 'S'+str(i+1), font=self.fnt, fill=color, anchor='ms')
+            d.text((x, y), 'S'+str(i+1), font=self.fnt, fill=color, anchor='ms')
 
     def renderFactionPositions(self):
         # faction info around the map of Arrakis
@@ -225,14 +382,9 @@ class Renderer:
             token_name = self.game_state['visual'].get(territory_name, None)
             if token_name is None:
                 continue
-            filename = pkg_resources.open_binary(assets, token_name)
-            token = Image.open(filename)
-            token = token.convert('RGBA')
-            width_token, height_token = token.size
-            token = token.resize((self.leader_size, self.leader_size), Image.ANTIALIAS)
+            token = self.sprites.get(token_name, (self.leader_size, self.leader_size))
             width_token, height_token = token.size
-            del filename
-            x, y = self.game_config['generated']['territories']['circles'][territory_name]
+            x, y = self.circle(territory_name)
             half_width = int(width_token/2)
             half_height = int(height_token/2)
             if y - half_height < 0:
@@ -245,11 +397,11 @@ class Renderer:
             x_info = 0
             y_info = 0
             if i == 1:
-                x_info = x + half_width + 5
+                x_info = x + half_width + self.px(5)
                 y_info = y
             if i == 4:
-                x_info = x + half_width + 5
-                y_info = 5
+                x_info = x + half_width + self.px(5)
+                y_info = self.px(5)
             if i == 2:
                 x_info = x - half_width
                 y_info = y + half_width
@@ -258,9 +410,9 @@ class Renderer:
                 y_info = y + half_width
             if i == 3:
                 x_info = x - half_width
-                y_info = y - half_height - 20 - 20
+                y_info = y - half_height - self.px(20) - self.px(20)
             if i == 5:
-                x_info = 5
+                x_info = self.px(5)
                 y_info = y + half_width
             text = '@' + self.game_state['meta']['usernames'][territory_name]
             text += '\n#' + self.game_state['meta']['user_discriminators'][territory_name]
@@ -275,15 +427,12 @@ class Renderer:
             disc_filename = self.game_config['files'][leader]
             x = int(token_instance['x'])
             y = int(token_instance['y'])
-            filename = pkg_resources.open_binary(assets, disc_filename)
-            token = Image.open(filename)
-            token = token.convert('RGBA')
-            token = token.resize((self.leader_size, self.leader_size), Image.ANTIALIAS)
-            width_token, height_token = token.size
+            token = self.sprites.get(disc_filename, (self.leader_size, self.leader_size))
             dx = int(self.leader_size/2)
             dy = int(self.leader_size/2)
             box_target = (x-dx, y-dy, x+dx, y+dy)
-            self.canvas.paste(token, box_target, mask=token)
+            if self.isDirty(box_target):
+                self.canvas.paste(token, box_target, mask=token)
             break
 
     def renderTleilaxuTanks(self):
@@ -294,40 +443,44 @@ class Renderer:
         map_object = self.game_state['visual']['tleilaxu_tanks']['whole']
         self.renderLeaders(map_object)
 
-    def renderGameInfo(self):
-        # game info
+    def gameInfoText(self):
         reg = 2*math.pi/18
         angle = (-3*2+4)*reg+reg/2
         dx = int(self.leader_r*math.cos(angle))
         x_info = int(self.width_canvas/2)+dx-int(self.leader_size/2)
-        y_info = 110
+        y_info = self.px(110)
         game_phase_name = (self.texts['game_phase']+'_phase').replace('_', ' ').title()
         game_name = self.texts['game_name'].replace('-', ' ').title()
         game_info = '{0}\nTurn {1}\n{2}'.format(game_name, str(self.texts['game_turn']), game_phase_name)
-        text = game_info
-        self.canvas, w, h = self.renderText(text, self.fnt, 'white', x_info, y_info, anchor=None)
+        return game_info, x_info, y_info
 
-    def renderLastCommands(self):
+    def lastCommandsText(self):
         text = '\n'.join(self.texts['commands'])
         lh = 0
         for cmd in self.texts['commands']:
             _, h = self.fnt.getsize(text)
             lh += h
-        x_info = 20
-        y_info = int(self.height_canvas-lh-20)
+        x_info = self.px(20)
+        y_info = int(self.height_canvas-lh-self.px(20))
+        return text, x_info, y_info
+
+    def renderGameInfo(self):
+        # game info
+        text, x_info, y_info = self.gameInfoText()
+        self.canvas, w, h = self.renderText(text, self.fnt, 'white', x_info, y_info, anchor=None)
+
+    def renderLastCommands(self):
+        text, x_info, y_info = self.lastCommandsText()
         self.canvas, _, _ = self.renderText(text, self.fnt, 'white', x_info, y_info, anchor=None)
 
     def shieldWall(self):
         if not self.game_state['meta'].get('shield_wall_destroyed', False):
             return None
         filename = self.game_config['files']['shield_wall_destroyed']
-        filename = pkg_resources.open_binary(assets, filename)
-        token = Image.open(filename)
-        token = token.convert('RGBA')
+        token = self.sprites.scaled(filename, self.scale) if self.scale != 1 else self.sprites.get(filename)
         width_token, height_token = token.size
-        del filename
-        x = self.game_config['generated']['shield_wall_token']['min_x']
-        y = self.game_config['generated']['shield_wall_token']['min_y']
+        x = self.px(self.game_config['generated']['shield_wall_token']['min_x'])
+        y = self.px(self.game_config['generated']['shield_wall_token']['min_y'])
         box_target = (
             int(x),
             int(y),
@@ -336,50 +489,185 @@ class Renderer:
         self.canvas.paste(token, box_target, mask=token)
 
     def render(self):
-        self.shieldWall()
-        self.placeStorm()
-        self.renderRegionMarks()
-        self.renderFactionPositions()
-        self.renderTleilaxuTanks()
-        self.renderTroops()
-        self.placeSpice()
-        # compose the text layer
-        self.canvas = Image.alpha_composite(self.canvas, self.txt)
-        self.renderBattle()
-        self.renderQR()
-        self.renderGameInfo()
-        self.renderLastCommands()
+        with self.profiler.stage('findDirtyRegions'):
+            self.dirty = self.findDirtyRegions(self.previous)
+        stages = [
+            ('shieldWall', self.shieldWall),
+            ('placeStorm', self.placeStorm),
+            ('renderFactionPositions', self.renderFactionPositions),
+            ('renderTleilaxuTanks', self.renderTleilaxuTanks),
+            ('renderTroops', self.renderTroops),
+            ('placeSpice', self.placeSpice),
+            # compose the text layer
+            ('compositeText', lambda: self.compositeLayer(self.txt)),
+            ('renderBattle', self.renderBattle),
+            ('placeOverlay', self.placeOverlay),
+            ('renderGameInfo', self.renderGameInfo),
+            ('renderLastCommands', self.renderLastCommands)
+        ]
+        for name, stage in stages:
+            with self.profiler.stage(name):
+                stage()
         # remove alpha
-        self.canvas = self.canvas.convert('RGB')
-        self.canvas.save(self.outfile, quality=self.quality)
+        with self.profiler.stage('flatten'):
+            if self.dirty is None:
+                image = self.canvas.convert('RGB')
+            else:
+                # only the changed regions are taken from this render
+                image = self.previous['image'].copy()
+                for box in self.dirty:
+                    image.paste(self.canvas.crop(box).convert('RGB'), box[:2])
+        if self.outfile is not None:
+            with self.profiler.stage('save'):
+                image.save(self.outfile, quality=self.quality)
+        with self.profiler.stage('frame'):
+            self.frame = {
+                'image': image,
+                'battle': self.battle,
+                'fixed': self.fixedKey(),
+                'visual': copy.deepcopy(self.game_state['visual']),
+                'texts': self.textItems()
+            }
         del self.canvas
+        return self.frame
+
+    def isDirty(self, box):
+        if self.dirty is None:
+            return True
+        left, top, right, bottom = box
+        for dleft, dtop, dright, dbottom in self.dirty:
+            if left < dright and dleft < right and top < dbottom and dtop < bottom:
+                return True
+        return False
+
+    def compositeLayer(self, layer):
+        if self.dirty is None:
+            self.canvas = Image.alpha_composite(self.canvas, layer)
+            return None
+        for box in self.dirty:
+            self.canvas.alpha_composite(layer, box[:2], box)
+
+    def clipBox(self, box, margin=0):
+        left, top, right, bottom = box
+        return (
+            max(int(math.floor(left))-margin, 0),
+            max(int(math.floor(top))-margin, 0),
+            min(int(math.ceil(right))+margin, self.width_canvas),
+            min(int(math.ceil(bottom))+margin, self.height_canvas))
+
+    def fixedKey(self):
+        # everything the renderer reads apart from the token positions and
+        # the game info texts, any change to it repaints the whole board
+        meta = dict(self.game_state['meta'])
+        texts = dict(meta.pop('texts', {}))
+        for key in ['commands', 'game_name', 'game_turn', 'game_phase']:
+            texts.pop(key, None)
+        fixed = {
+            'size': self.canvas.size,
+            'meta': meta,
+            'texts': texts,
+            'configs': self.game_state['configs']
+        }
+        return json.dumps(fixed, sort_keys=True, default=str)
+
+    def visualItems(self, visual):
+        items = {}
+        rest = {}
+        _, spice_size = self.spiceSize()
+        spice_radius = spice_size/2
+        for territory_name, entry in visual.items():
+            if territory_name == 'storm':
+                _, box = self.stormSprite(entry)
+                items[territory_name] = box, json.dumps(entry, sort_keys=True)
+            elif territory_name.endswith('_spice'):
+                x, y = self.circle(territory_name)
+                r = spice_radius
+                items[territory_name] = (x-r, y-r, x+r, y+r), entry
+            elif type(entry) is dict and not territory_name.startswith('wheel_'):
+                for sector_name, token_object in entry.items():
+                    for token_name, token_instance in token_object.items():
+                        r = self.leader_size/2
+                        if token_instance['type'] == 'troop_token':
+                            r = self.troop_size/2
+                        x, y = token_instance['x'], token_instance['y']
+                        key = territory_name, sector_name, token_name
+                        items[key] = (x-r, y-r, x+r, y+r), json.dumps(token_instance, sort_keys=True)
+            else:
+                rest[territory_name] = entry
+        return items, rest
+
+    def textItems(self):
+        items = {}
+        draw = ImageDraw.Draw(self.txt)
+        for name, (text, x, y) in [('game_info', self.gameInfoText()), ('commands', self.lastCommandsText())]:
+            box = draw.textbbox((x, y), text, font=self.fnt)
+            items[name] = text, self.clipBox(box, margin=2)
+        return items
+
+    def findDirtyRegions(self, previous):
+        # None means the whole board has to be repainted
+        if previous is None or self.battle or previous['battle']:
+            return None
+        if previous['fixed'] != self.fixedKey():
+            return None
+        old_items, old_rest = self.visualItems(previous['visual'])
+        new_items, new_rest = self.visualItems(self.game_state['visual'])
+        if json.dumps(old_rest, sort_keys=True) != json.dumps(new_rest, sort_keys=True):
+            return None
+        boxes = []
+        for key in set(old_items.keys()) | set(new_items.keys()):
+            old = old_items.get(key, None)
+            new = new_items.get(key, None)
+            if old == new:
+                continue
+            if old is not None:
+                boxes.append(self.clipBox(old[0], margin=2))
+            if new is not None:
+                boxes.append(self.clipBox(new[0], margin=2))
+        new_texts = self.textItems()
+        for name, (text, box) in previous['texts'].items():
+            if new_texts[name][0] != text:
+                boxes.append(box)
+                boxes.append(new_texts[name][1])
+        return self.mergeBoxes([box for box in boxes if box[0] < box[2] and box[1] < box[3]])
+
+    def mergeBoxes(self, boxes):
+        # overlapping boxes are joined until all are disjoint, the layers
+        # are composited once per box and would otherwise be applied twice
+        merged = []
+        for box in boxes:
+            left, top, right, bottom = box
+            overlapping = True
+            while overlapping:
+                overlapping = False
+                for other in merged:
+                    if left < other[2] and other[0] < right and top < other[3] and other[1] < bottom:
+                        merged.remove(other)
+                        left, top = min(left, other[0]), min(top, other[1])
+                        right, bottom = max(right, other[2]), max(bottom, other[3])
+                        overlapping = True
+                        break
+            merged.append((left, top, right, bottom))
+        return merged
 
     def placeSpice(self):
-        params = self.game_state['configs'].get('spice_token', ['czempak_spice_1', self.spice_size])
-        if params[1] is None:
-            params[1] = self.spice_size
-        filename = params[0] + '.png'
-        spice_size = params[1]
-        filename = pkg_resources.open_binary(assets, filename)
-        token = Image.open(filename)
-        token = token.convert('RGBA')
-        width_token, height_token = token.size
-        token = token.resize((spice_size, spice_size), Image.ANTIALIAS)
+        name, spice_size = self.spiceSize()
+        filename = name + '.png'
+        token = self.sprites.get(filename, (spice_size, spice_size))
         width_token, height_token = token.size
-        del filename
-        filename = pkg_resources.open_binary(assets, 'RobotoCondensed-Bold.ttf')
-        fnt_troop = ImageFont.truetype(filename, 22)
-        del filename
+        fnt_troop = self.fnt_troop
         half_width = int(width_token/2)
         half_height = int(height_token/2)
         for territory_name, amount in self.game_state['visual'].items():
             if territory_name.endswith('_spice'):
-                x, y = self.game_config['generated']['territories']['circles'][territory_name]
+                x, y = self.circle(territory_name)
                 box_target = (
                     int(x-width_token/2),
                     int(y-width_token/2),
                     int(x+width_token/2),
                     int(y+height_token/2))
+                if not self.isDirty(box_target):
+                    continue
                 self.canvas.paste(token, box_target, mask=token)
                 text = str(amount)
                 w, h = fnt_troop.getsize(text)
@@ -389,51 +677,14 @@ class Renderer:
         storm_object = self.game_state['visual'].get('storm', None)
         if storm_object is None:
             return
-        filename = pkg_resources.open_binary(assets, storm_object['token'])
-        token = Image.open(filename)
-        token = token.convert('RGBA')
-        width_token, height_token = token.size
-        scale = storm_object['s']
-        angle = storm_object['a']
-        x = storm_object['x']
-        y = storm_object['y']
-        token = token.resize((int(scale*width_token), int(scale*height_token)), Image.ANTIALIAS)
-        token = token.rotate(angle, Image.NEAREST, expand=1)
-        width_token, height_token = token.size
-        del filename
-        x_diff = int(math.ceil(x - int(math.floor(width_token/2))))
-        if x_diff < 0:
-            box = (
-                -x_diff,
-                0,
-                width_token,
-                height_token
-            )
-            token = token.crop(box)
-            width_token, height_token = token.size
-            x = 0
-        else:
-            x -= int(math.floor(width_token/2))
-        y_diff = int(math.ceil(y - int(math.floor(height_token/2))))
-        if y_diff < 0:
-            box = (
-                0,
-                -y_diff,
-                width_token,
-                height_token
-            )
-            token = token.crop(box)
-            width_token, height_token = token.size
-            y = 0
-        else:
-            y -= int(math.floor(height_token/2))
-        y_diff = int(math.ceil(y - int(math.floor(height_token/2))))
-        box_target = (
-            int(x),
-            int(y),
-            int(x+width_token),
-            int(y+height_token))
-        self.canvas.paste(token, box_target, mask=token)
+        token, box_target = self.stormSprite(storm_object)
+        if self.isDirty(box_target):
+            self.canvas.paste(token, box_target, mask=token)
+
+    def stormSprite(self, storm_object):
+        center = tuple(v*self.scale for v in stormCenter(self.game_config))
+        atlas = getStormAtlas(center, storm_object['token'], storm_object['s'])
+        return atlas.get(storm_object)
 
     # ref: https://code-maven.com/slides/python/rectangle-with-rounded-corners
     def round_corner(self, radius, fill):
@@ -453,53 +704,57 @@ class Renderer:
         rectangle.paste(corner.rotate(270), (width - radius, 0))
         return rectangle
 
-    def render_card(self, card_object):
-        radius = self.card_radius
-        fill = 'white'
-        # card = self.round_rectangle(size, radius, fill)
+    def render_card(self, card_object, thumbnail=False):
         params = self.game_state['configs'].get('card_background', ['czempak_card_background', self.card_unit])
         filename = params[0] + '.png'
         unit = params[1]
-        filename = pkg_resources.open_binary(assets, filename)
-        width = 25*unit
-        height = 35*unit
+        width = self.tokenSize(25*unit)
+        height = self.tokenSize(35*unit)
         size = width, height
-        token = Image.open(filename)
-        token = token.convert('RGBA')
-        width_token, height_token = token.size
-        token = token.resize((width, height), Image.ANTIALIAS)
+        key = card_object.get('card', None), filename, unit, self.scale
+        card = card_faces.fetch(key, lambda: self.drawCard(card_object, filename, size))
+        if thumbnail:
+            width, height = width//2, height//2
+            card = card_faces.fetch(key + ('thumbnail',), lambda: card.resize((width, height), Image.LANCZOS))
+        return card, width, height
+
+    def warmCardFaces(self, card_ids=None):
+        if card_ids is None:
+            card_ids = self.card_objects.keys()
+        for card_id in card_ids:
+            self.render_card(self.card_objects[card_id])
+
+    def drawCard(self, card_object, filename, size):
+        radius = self.card_radius
+        fill = 'white'
+        # card = self.round_rectangle(size, radius, fill)
+        token = self.sprites.get(filename, size)
         width_token, height_token = token.size
-        del filename
-        card = token
+        # text is composited in place, keep the cached background intact
+        card = token.copy()
         # render card content
         text = card_object.get('header', '')
-        x, y = 10, 10
+        x, y = self.px(10), self.px(10)
         for line in textwrap.wrap(text, width=12):
             card, w, h = self.renderText(line, self.fnt_card_large, 'white', x, y, anchor=None, canvas=card)
-            y += h + 9
-        y += 10
+            y += h + self.px(9)
+        y += self.px(10)
         text = card_object.get('description', '')
         for line in textwrap.wrap(text, width=30):
             card, w, h = self.renderText(line, self.fnt_card_tiny, 'white', x, y, anchor=None, canvas=card)
-            y += 14
+            y += self.px(14)
         text = card_object.get('type', '')
         text_subtype = card_object.get('subtype', None)
         if text_subtype is not None:
             text += ' / ' + text_subtype
-        x, y = 10, height_token - 12 - h
+        x, y = self.px(10), height_token - self.px(12) - h
         card, w, h = self.renderText(text, self.fnt_card_small, 'white', x, y, anchor=None, canvas=card)
-        return card, width, height
+        return card
 
     def placeWheel(self, x, y, width, angle, username_territory=None, faction_territory=None, leader=None):
-        filename = pkg_resources.open_binary(assets,
-        'battle_wheel_numbers.png')
-        token = Image.open(filename)
-        token = token.convert('RGBA')
-        width_token, height_token = token.size
-        token = token.resize((width, width), Image.ANTIALIAS)
-        token = token.rotate(angle, Image.NEAREST, expand=1)
+        atlas = getWheelAtlas(width)
+        token = atlas.getNumbers(angle)
         width_token, height_token = token.size
-        del filename
         box_target = (
             int(x-width_token/2),
             int(y-height_token/2),
@@ -507,14 +762,8 @@ class Renderer:
             int(y+height_token/2))
         self.canvas.paste(token, box_target, mask=token)
         # top of the wheel
-        filename = pkg_resources.open_binary(assets,
-                                             'battle_wheel_top.png')
-        token = Image.open(filename)
-        token = token.convert('RGBA')
+        token = atlas.top
         width_token, height_token = token.size
-        token = token.resize((width, width), Image.ANTIALIAS)
-        width_token, height_token = token.size
-        del filename
         box_target = (
             int(x-width_token/2),
             int(y-height_token/2),
@@ -522,10 +771,7 @@ class Renderer:
             int(y+height_token/2))
         self.canvas.paste(token, box_target, mask=token)
         if leader is not None:
-            filename = pkg_resources.open_binary(assets, leader)
-            token = Image.open(filename)
-            token = token.convert('RGBA')
-            token = token.resize((self.leader_size, self.leader_size), Image.ANTIALIAS)
+            token = self.sprites.get(leader, (self.leader_size, self.leader_size))
             width_token, height_token = token.size
             dx = int(self.leader_size/2)
             dy = int(self.leader_size/2)
@@ -546,13 +792,22 @@ class Renderer:
         if canvas is None:
             canvas = self.canvas
         w, h = self.fnt_troop.getsize(text)
-        txt = Image.new('RGBA', canvas.size, (255,255,255,0))
-        draw = ImageDraw.Draw(txt)
         yt = y
         if ycenter:
             yt = y+h/2-2
-        draw.text((x, yt), text, font=font, fill=fill, anchor=anchor)
-        canvas = Image.alpha_composite(canvas, txt)
+        # only the bounding box of the string gets composited, the offset
+        # is integer so the glyphs rasterize exactly as on a full layer
+        left, top, right, bottom = ImageDraw.Draw(canvas).textbbox((x, yt), text, font=font, anchor=anchor)
+        left = max(int(math.floor(left))-1, 0)
+        top = max(int(math.floor(top))-1, 0)
+        right = min(int(math.ceil(right))+1, canvas.size[0])
+        bottom = min(int(math.ceil(bottom))+1, canvas.size[1])
+        if right <= left or bottom <= top:
+            return canvas, w, h
+        txt = Image.new('RGBA', (right-left, bottom-top), (255,255,255,0))
+        draw = ImageDraw.Draw(txt)
+        draw.text((x-left, yt-top), text, font=font, fill=fill, anchor=anchor)
+        canvas.alpha_composite(txt, (left, top))
         return canvas, w, h
 
     def extractCards(self, cards_object):
@@ -564,18 +819,12 @@ class Renderer:
     def renderBattle(self):
         if not self.battle:
             return None
-        TINT_COLOR = (0, 0, 0)  # Black
         TRANSPARENCY = 0.65  # Degree of transparency, 0-100%
         OPACITY = int(255 * TRANSPARENCY)
-        overlay = Image.new('RGBA', self.canvas.size, TINT_COLOR+(0,))
-        draw = ImageDraw.Draw(overlay)  # Create a context for drawing things on it.
-        draw.rectangle(
-            (
-                (0, 0),
-                (self.width_canvas, self.height_canvas)
-            ),
-            fill=TINT_COLOR+(OPACITY,))
-        self.canvas = Image.alpha_composite(self.canvas, overlay)
+        # alpha is dropped before saving, so the black tint only needs to
+        # darken the colour bands, a lookup instead of an overlay composite
+        shade = [int(round(v*(255-OPACITY)/255)) for v in range(256)]
+        self.canvas = self.canvas.point(3*shade + list(range(256)))
         # place left wheel
         xthird = int(self.width_canvas/3)
         ythird = int(self.height_canvas/3)
@@ -621,6 +870,73 @@ class Renderer:
         faction_territory = 'wheel_defender_player_faction'
         self.placeWheel(x, y, width, angle, username_territory=username_territory, faction_territory=faction_territory, leader=leader)
 
+    def renderViews(self, image, hands):
+        # the public board and, for every faction, the board with its hand
+        # strip underneath, all from the same rendered board image
+        views = {'public': image}
+        for faction, hand in hands.items():
+            strip = self.handStrip(hand)
+            view = Image.new('RGB', (image.size[0], image.size[1]+strip.size[1]))
+            view.paste(image, (0, 0))
+            view.paste(strip.convert('RGB'), (0, image.size[1]))
+            views[faction] = view
+        return views
+
+    def handStrip(self, hand):
+        # lays the hand tiles out in rows under the board
+        margin = self.px(20)
+        spacing = self.px(10)
+        tiles = self.handTiles(hand)
+        rows = [[]]
+        x = margin
+        for tile in tiles:
+            if x + tile.size[0] > self.width_canvas - margin and len(rows[-1]) > 0:
+                rows.append([])
+                x = margin
+            rows[-1].append(tile)
+            x += tile.size[0] + spacing
+        heights = [max([tile.size[1] for tile in row]) for row in rows]
+        strip = Image.new('RGBA', (self.width_canvas, sum(heights) + (len(rows)-1)*spacing + 2*margin), HAND_BACKGROUND)
+        y = margin
+        for row, height in zip(rows, heights):
+            x = margin
+            for tile in row:
+                self.pasteSprite(strip, tile, x, y + (height-tile.size[1])/2)
+                x += tile.size[0] + spacing
+            y += height + spacing
+        return strip
+
+    def handTiles(self, hand):
+        tiles = []
+        # faction name and spice
+        text = '{0}\nSpice {1}'.format(hand['faction_name'], hand['spice'])
+        left, top, right, bottom = ImageDraw.Draw(self.base['labels']).multiline_textbbox((0, 0), text, font=self.fnt_card_large)
+        tile = Image.new('RGBA', (int(math.ceil(right)), int(math.ceil(bottom))), (255,255,255,0))
+        ImageDraw.Draw(tile).multiline_text((0, 0), text, font=self.fnt_card_large, fill='white')
+        tiles.append(tile)
+        # leaders with their strength underneath
+        for leader, _, _, strength in hand['leaders']:
+            token = self.sprites.get(self.game_config['files'][leader], (self.leader_size, self.leader_size))
+            label_height = self.px(28)
+            tile = Image.new('RGBA', (self.leader_size, self.leader_size+label_height), (255,255,255,0))
+            tile.alpha_composite(token)
+            ImageDraw.Draw(tile).text((self.leader_size/2, self.leader_size+label_height/2), str(strength), font=self.fnt_troop, fill='white', anchor='mm')
+            tiles.append(tile)
+        # troops in reserve
+        for troop_type, number in hand['reserves'].items():
+            if number == 0:
+                continue
+            disc, label, (dx, dy) = self.troopSprite(troop_type, number)
+            tile = disc.copy()
+            half = disc.size[0]/2
+            self.pasteSprite(tile, label, half+dx, half+dy)
+            tiles.append(tile)
+        # treachery and other cards, half the size they have on the battle wheel
+        for card_id in self.extractCards(hand['cards']):
+            card, _, _ = self.render_card(self.card_objects[card_id], thumbnail=True)
+            tiles.append(card)
+        return tiles
+
 
 def generateNeighborhood(centers, locations, neighbors, sectors, outfile, quality=95, skip=[]):
     dl = 10
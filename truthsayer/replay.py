@@ -0,0 +1,208 @@
+import io
+import abc
+import json
+import struct
+import zlib
+
+from diff_match_patch import diff_match_patch
+from PIL import Image, ImageChops, GifImagePlugin
+
+from truthsayer.processor import OriginatorTruthsayer
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# palette index left for the pixels that did not change since the last frame
+GIF_TRANSPARENT = 255
+
+
+def historyStates(caretaker):
+    # yields the state at every backup, oldest first, the reverse patches are
+    # walked back once and only the forward patches kept
+    dmp = diff_match_patch()
+    state = caretaker._state
+    forward = []
+    for memento in reversed(caretaker._past):
+        patches = dmp.patch_fromText(memento.get_diff())
+        older, _ = dmp.patch_apply(patches, state)
+        forward.append(dmp.patch_make(older, state))
+        state = older
+    yield json.loads(state)
+    for patches in reversed(forward):
+        state, _ = dmp.patch_apply(patches, state)
+        yield json.loads(state)
+
+
+def changedMask(previous, image):
+    # L mask of the pixels that differ in any of the bands
+    bands = ImageChops.difference(previous, image).split()
+    mask = bands[0]
+    for band in bands[1:]:
+        mask = ImageChops.lighter(mask, band)
+    return mask.point(lambda v: 255 if v else 0)
+
+
+def pngChunks(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    data = buffer.getvalue()
+    offset = len(PNG_SIGNATURE)
+    while offset < len(data):
+        length, kind = struct.unpack('>I4s', data[offset:offset+8])
+        yield kind, data[offset+8:offset+8+length]
+        offset += length+12
+
+
+# the first frame is stored whole, the following ones only the box of the
+# pixels that changed, the unchanged pixels in it left transparent
+class ReplayWriter(abc.ABC):
+    def __init__(self, fp, frames, duration=500, loop=0):
+        self.fp = fp
+        self.frames = frames
+        self.duration = duration
+        self.loop = loop
+        self.written = 0
+
+    def write(self, data):
+        self.fp.write(data)
+        self.written += len(data)
+
+    @abc.abstractmethod
+    def start(self, image):
+        pass
+
+    @abc.abstractmethod
+    def frame(self, image, box, mask):
+        pass
+
+    @abc.abstractmethod
+    def close(self):
+        pass
+
+
+class GifWriter(ReplayWriter):
+    def paletted(self, image):
+        image = image.quantize(GIF_TRANSPARENT)
+        palette = image.getpalette()
+        image.putpalette(palette + [0]*(768-len(palette)))
+        return image
+
+    def writeImage(self, image, offset, transparency=None):
+        params = {'duration': self.duration, 'disposal': 1, 'include_color_table': True, 'optimize': False}
+        if transparency is not None:
+            params['transparency'] = transparency
+        for fragment in GifImagePlugin.getdata(image, offset=offset, **params):
+            self.write(fragment)
+
+    def start(self, image):
+        width, height = image.size
+        self.write(b'GIF89a' + struct.pack('<HHBBB', width, height, 0, 0, 0))
+        self.write(b'!\xff\x0bNETSCAPE2.0\x03\x01' + struct.pack('<H', self.loop) + b'\x00')
+        self.writeImage(self.paletted(image), (0, 0))
+
+    def frame(self, image, box, mask):
+        if box is None:
+            # nothing changed, a single transparent pixel holds the timing
+            patch = Image.new('P', (1, 1), GIF_TRANSPARENT)
+            patch.putpalette([0]*768)
+            self.writeImage(patch, (0, 0), GIF_TRANSPARENT)
+            return None
+        patch = self.paletted(image.crop(box))
+        patch.paste(GIF_TRANSPARENT, mask=ImageChops.invert(mask.crop(box)))
+        self.writeImage(patch, box[:2], GIF_TRANSPARENT)
+
+    def close(self):
+        self.write(b';')
+
+
+class ApngWriter(ReplayWriter):
+    def __init__(self, fp, frames, duration=500, loop=0):
+        super().__init__(fp, frames, duration, loop)
+        self.sequence = 0
+
+    def chunk(self, kind, data):
+        crc = zlib.crc32(kind + data) & 0xffffffff
+        self.write(struct.pack('>I', len(data)) + kind + data + struct.pack('>I', crc))
+
+    def control(self, box):
+        left, top, right, bottom = box
+        data = struct.pack('>IIIIIHHBB', self.sequence, right-left, bottom-top, left, top, self.duration, 1000, 0, 1)
+        self.sequence += 1
+        self.chunk(b'fcTL', data)
+
+    def start(self, image):
+        self.write(PNG_SIGNATURE)
+        chunks = list(pngChunks(image.convert('RGBA')))
+        self.chunk(b'IHDR', chunks[0][1])
+        self.chunk(b'acTL', struct.pack('>II', self.frames, self.loop))
+        self.control((0, 0) + image.size)
+        for kind, data in chunks:
+            if kind == b'IDAT':
+                self.chunk(b'IDAT', data)
+
+    def frame(self, image, box, mask):
+        if box is None:
+            # nothing changed, a single transparent pixel holds the timing
+            box = 0, 0, 1, 1
+            patch = Image.new('RGBA', (1, 1), (0, 0, 0, 0))
+        else:
+            # unchanged pixels are left fully transparent, zeros compress away
+            left, top, right, bottom = box
+            patch = Image.new('RGBA', (right-left, bottom-top), (0, 0, 0, 0))
+            patch.paste(image.crop(box).convert('RGBA'), (0, 0), mask.crop(box))
+        self.control(box)
+        for kind, data in pngChunks(patch):
+            if kind == b'IDAT':
+                self.chunk(b'fdAT', struct.pack('>I', self.sequence) + data)
+                self.sequence += 1
+
+    def close(self):
+        self.chunk(b'IEND', b'')
+
+
+REPLAY_FORMATS = {
+    'gif': GifWriter,
+    'png': ApngWriter,
+    'apng': ApngWriter
+}
+
+
+def replayFormatOf(outfile, default='gif'):
+    if isinstance(outfile, str):
+        extension = outfile.rsplit('.', 1)[-1].lower()
+        if extension in REPLAY_FORMATS.keys():
+            return extension
+    return default
+
+
+def exportReplay(caretaker, outfile, format=None, duration=500, loop=0, scale=1.0, battle=False):
+    # renders every backup on a detached copy of the game, the live originator
+    # is left untouched, frames are written out as soon as they are ready
+    if format is None:
+        format = replayFormatOf(outfile)
+    if format.lower() not in REPLAY_FORMATS.keys():
+        raise ValueError('Unsupported replay format {0}'.format(format))
+    states = historyStates(caretaker)
+    replica = OriginatorTruthsayer(game_state=next(states))
+    fp = outfile if hasattr(outfile, 'write') else open(outfile, 'wb')
+    try:
+        writer = REPLAY_FORMATS[format.lower()](fp, len(caretaker._past)+1, duration, loop)
+        image = replica.renderFrame(battle=battle, scale=scale)['image']
+        writer.start(image)
+        for state in states:
+            previous = image
+            replica._object_state = state
+            image = replica.renderFrame(battle=battle, scale=scale)['image']
+            mask = changedMask(previous, image)
+            writer.frame(image, mask.getbbox(), mask)
+        writer.close()
+    finally:
+        if fp is not outfile:
+            fp.close()
+    width, height = image.size
+    return {
+        'format': format.lower(),
+        'frames': writer.frames,
+        'width': width,
+        'height': height,
+        'bytes': writer.written
+    }
@@ -0,0 +1,42 @@
+import json
+import hashlib
+
+from truthsayer.cache import LRUCache, TieredCache
+from truthsayer.encoding import EncodedImage
+
+
+def renderDigest(game_state, battle=False, scale=1.0, **params):
+    # stable hash of everything a render reads from the state, codec settings
+    # are hashed along, equal digests give byte-identical images
+    wheels = {key: value for key, value in game_state['territories'].items() if key.startswith('wheel_')}
+    content = {
+        'visual': game_state['visual'],
+        'meta': game_state['meta'],
+        'configs': game_state['configs'],
+        'wheels': wheels,
+        'battle': battle,
+        'scale': scale,
+        'params': params
+    }
+    data = json.dumps(content, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+# encoded renders keyed by the digest of their input
+class RenderCache(TieredCache):
+    suffixes = ('.bin', '.json')
+
+    def __init__(self, max_bytes=64*2**20, directory=None, max_disk_bytes=2**30):
+        super().__init__(LRUCache(max_bytes, weigh=lambda result: result.size), directory, max_disk_bytes)
+
+    def dump(self, result):
+        meta = result.report()
+        meta.pop('bytes')
+        return [result.data, json.dumps(meta).encode('utf-8')]
+
+    def load(self, contents):
+        data, meta = contents
+        return EncodedImage(data, **json.loads(meta))
+
+
+render_results = RenderCache()
@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import heapq
+import itertools
+import threading
+
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from truthsayer.processor import RenderingProcessor, CardsManager
+from truthsayer.renderer import Renderer, warmFonts
+from truthsayer.sprites import sprites
+from truthsayer.encoding import encode
+from truthsayer.placements import placement_results
+
+
+# lower values are rendered first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_DEFAULT = 5
+PRIORITY_BACKGROUND = 10
+
+# per worker process state, set up once by the pool initializer
+_worker = {}
+
+
+class QueueFullError(Exception):
+    pass
+
+
+def initWorker(placements=None, meta=None):
+    if placements is not None:
+        # the workers share solved placements through this directory
+        placement_results.directory = placements
+    processor = RenderingProcessor()
+    cards_manager = CardsManager()
+    _worker['processor'] = processor
+    _worker['cards_manager'] = cards_manager
+    warmFonts()
+    sprites.warm(list(processor.game_config['files'].values()))
+    # a renderer of an empty board builds the base layer for the texts of
+    # meta, then the troop sprites, card faces and atlases are drawn ahead
+    if meta is None:
+        meta = {'factions': {}, 'texts': {}}
+    game_state = {'territories': {}, 'visual': {}, 'meta': meta, 'configs': {}}
+    renderer = Renderer(game_state, processor.game_config, cards_manager.card_objects, None)
+    renderer.warmTroopSprites()
+    renderer.warmCardFaces()
+    renderer.warmAtlases(processor.calculateStormPosition(1))
+
+
+def renderJob(state, battle=False, scale=1.0, params={}):
+    # runs in the worker, returns the encoded image and the token placements
+    if len(_worker) == 0:
+        initWorker()
+    processor = _worker['processor']
+    game_state = processor.process(json.loads(state))
+    renderer = Renderer(
+        game_state,
+        processor.game_config,
+        _worker['cards_manager'].card_objects,
+        None,
+        battle=battle,
+        scale=scale)
+    frame = renderer.render()
+    return {
+        'image': encode(frame['image'], **params),
+        'visual': game_state['visual']
+    }
+
+
+class RenderJob:
+    def __init__(self, game_id, state, priority, battle, scale, params):
+        self.game_id = game_id
+        self.state = state
+        self.priority = priority
+        self.battle = battle
+        self.scale = scale
+        self.params = params
+        self.future = Future()
+        self.submitted = time.perf_counter()
+        self.started = None
+
+
+# renders serialized states on worker processes, jobs wait in a bounded
+# priority queue and a newer state of a game replaces its queued one
+class RenderScheduler:
+    def __init__(self, workers=None, max_queue=64, history=1000, placements=None, meta=None):
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.max_queue = max_queue
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=initWorker, initargs=(placements, meta))
+        self.queue = []
+        self.queued = {}
+        self.running = 0
+        self.closed = False
+        self.counter = itertools.count()
+        self.counts = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'coalesced': 0,
+            'rejected': 0
+        }
+        self.waits = deque(maxlen=history)
+        self.latencies = deque(maxlen=history)
+        self._condition = threading.Condition()
+        self._dispatcher = threading.Thread(target=self.dispatch, daemon=True)
+        self._dispatcher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def submit(self, game_id, game_state, priority=PRIORITY_DEFAULT, battle=False, scale=1.0, block=True, timeout=None, **params):
+        # game_state is a JSON string or a state dictionary serialized right away,
+        # the future resolves to the encoded image and the token placements
+        if type(game_state) is not str:
+            game_state = json.dumps(game_state)
+        job = RenderJob(game_id, game_state, priority, battle, scale, params)
+        deadline = None if timeout is None else time.perf_counter()+timeout
+        with self._condition:
+            if self.closed:
+                raise RuntimeError('Scheduler is shut down')
+            while True:
+                superseded = self.queued.pop(game_id, None)
+                if superseded is not None:
+                    superseded.future.cancel()
+                    self.counts['coalesced'] += 1
+                if len(self.queued) < self.max_queue:
+                    break
+                remaining = None if deadline is None else deadline-time.perf_counter()
+                if not block or (remaining is not None and remaining <= 0):
+                    self.counts['rejected'] += 1
+                    raise QueueFullError('Render queue is full')
+                self._condition.wait(remaining)
+                if self.closed:
+                    raise RuntimeError('Scheduler is shut down')
+            self.queued[game_id] = job
+            heapq.heappush(self.queue, (priority, next(self.counter), job))
+            self.counts['submitted'] += 1
+            self._condition.notify_all()
+        return job.future
+
+    def nextJob(self):
+        # pops the most urgent job that was not cancelled meanwhile
+        while len(self.queue) > 0:
+            _, _, job = heapq.heappop(self.queue)
+            if self.queued.get(job.game_id, None) is job:
+                del self.queued[job.game_id]
+            if job.future.set_running_or_notify_cancel():
+                return job
+        return None
+
+    def dispatch(self):
+        while True:
+            with self._condition:
+                while not self.closed and (self.running >= self.workers or len(self.queue) == 0):
+                    self._condition.wait()
+                if self.closed:
+                    return None
+                job = self.nextJob()
+                if job is None:
+                    continue
+                self.running += 1
+                # a slot in the queue was freed
+                self._condition.notify_all()
+            job.started = time.perf_counter()
+            try:
+                pending = self.pool.submit(renderJob, job.state, job.battle, job.scale, job.params)
+            except Exception as e:
+                self.finish(job, None, e)
+                continue
+            pending.add_done_callback(lambda pending, job=job: self.finish(job, pending))
+
+    def finish(self, job, pending, error=None):
+        if error is None:
+            error = pending.exception()
+        finished = time.perf_counter()
+        with self._condition:
+            self.running -= 1
+            self.waits.append(job.started-job.submitted)
+            self.latencies.append(finished-job.submitted)
+            self.counts['failed' if error is not None else 'completed'] += 1
+            self._condition.notify_all()
+        if error is not None:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(pending.result())
+
+    def summary(self, values):
+        values = sorted(values)
+        if len(values) == 0:
+            return None
+        return {
+            'mean': sum(values)/len(values),
+            'p50': values[len(values)//2],
+            'p95': values[min(int(0.95*len(values)), len(values)-1)],
+            'max': values[-1]
+        }
+
+    def stats(self):
+        with self._condition:
+            stats = dict(self.counts)
+            stats['depth'] = len(self.queued)
+            stats['running'] = self.running
+            stats['wait'] = self.summary(self.waits)
+            stats['latency'] = self.summary(self.latencies)
+        return stats
+
+    def shutdown(self, wait=True):
+        with self._condition:
+            self.closed = True
+            for _, _, job in self.queue:
+                job.future.cancel()
+            self.queue = []
+            self.queued = {}
+            self._condition.notify_all()
+        self._dispatcher.join()
+        self.pool.shutdown(wait=wait)
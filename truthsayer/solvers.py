@@ -0,0 +1,178 @@
+import math
+import time
+import random
+
+import shapely
+import numpy as np
+
+from truthsayer.opti import Solution, evolve, stopReason
+from truthsayer.raster import RasterPlacer
+
+
+# one raster placer per resolution, the masks of the cells are kept there
+raster_placers = {}
+
+
+def centersOf(state):
+    return np.asarray(state, dtype=float).reshape(-1, 2)
+
+
+def finish(problem, centers, evaluations, iterations, reason):
+    # scores the final centers with the shared objective
+    bad, violations = problem.evaluate(centers[None])
+    solution = Solution(problem.stateOf(centers), -bad[0], violations[0], evaluations+1, iterations, reason)
+    return solution
+
+
+def generator():
+    # seeded from the random module, seeding it reproduces the searches
+    return np.random.default_rng(random.getrandbits(32))
+
+
+def jitter(rng, centers, count, sigma, token=None):
+    # count copies of the centers, each with one token moved at random
+    candidates = np.repeat(centers[None], count, axis=0)
+    tokens = rng.integers(len(centers), size=count) if token is None else np.full(count, token)
+    candidates[np.arange(count), tokens] += rng.normal(0, sigma, (count, 2))
+    return candidates
+
+
+def hexLattice(bounds, spacing, phase):
+    minx, miny, maxx, maxy = bounds
+    height = spacing*math.sqrt(3)/2
+    points = []
+    for row, y in enumerate(np.arange(miny+phase[1]*height, maxy+height, height)):
+        shift = (phase[0]+(row % 2)/2)*spacing
+        for x in np.arange(minx+shift, maxx+spacing, spacing):
+            points.append((x, y))
+    return np.asarray(points).reshape(-1, 2)
+
+
+def lattice(problem, budget=None, phases=3, stop_when_valid=True):
+    # tokens on the points of shifted hexagonal lattices furthest from the
+    # border and the tokens to avoid, larger tokens deeper, the best
+    # arrangement is kept, the cost is bounded and the budget not needed
+    cell = problem.cell
+    radius = max(problem.radii)
+    minx, miny, maxx, maxy = cell.bounds
+    bounds = minx-radius, miny-radius, maxx+radius, maxy+radius
+    order = sorted(range(len(problem.radii)), key=lambda j: -problem.radii[j])
+    arrangements = []
+    for px in range(phases):
+        for py in range(phases):
+            points = hexLattice(bounds, 2*radius, (px/phases, py/phases))
+            clearance = shapely.distance(cell.polygon.boundary, shapely.points(points))
+            clearance = np.where(shapely.contains_xy(cell.polygon, points[:, 0], points[:, 1]), clearance, -clearance)
+            for x, y, r in problem.avoid_circles:
+                clearance = np.minimum(clearance, np.sqrt((points[:, 0]-x)**2+(points[:, 1]-y)**2)-r)
+            deepest = points[np.argsort(-clearance, kind='stable')]
+            centers = np.tile(cell.centroid, (len(order), 1))
+            for j, point in zip(order, deepest):
+                centers[j] = point
+            arrangements.append(centers)
+    arrangements = np.asarray(arrangements)
+    bad, _ = problem.evaluate(arrangements)
+    return finish(problem, arrangements[int(np.argmin(bad))], len(arrangements), 1, 'placed')
+
+
+def anneal(problem, budget=None, iterations_limit=500, neighbors=16, stop_when_valid=True):
+    # every step scores a batch of neighbors, each with one token moved by a
+    # step shrinking with the temperature, and takes the best by Metropolis
+    deadline = None if budget is None else time.perf_counter()+budget
+    rng = generator()
+    current = centersOf(problem.generate_random_state())
+    bad, violations = problem.evaluate(current[None])
+    current_bad = bad[0]
+    solution = Solution(problem.stateOf(current), -bad[0], violations[0])
+    evaluations = 1
+    temperature = None
+    iteration = 0
+    while True:
+        reason = stopReason(problem, solution, iteration, iterations_limit, deadline, stop_when_valid)
+        if reason is not None:
+            break
+        cooling = 1-iteration/iterations_limit
+        candidates = jitter(rng, current, neighbors, max(problem.radii)*cooling+1)
+        bad, violations = problem.evaluate(candidates)
+        evaluations += neighbors
+        iteration += 1
+        if temperature is None:
+            # the first spread of the objective sets the scale of the temperature
+            temperature = max(float(np.std(bad)), 1e-9)
+        j = int(np.argmin(bad))
+        delta = bad[j]-current_bad
+        if delta < 0 or random.random() < math.exp(-delta/(temperature*cooling+1e-9)):
+            current, current_bad = candidates[j], bad[j]
+        if -bad[j] > solution.value:
+            solution = Solution(problem.stateOf(candidates[j]), -bad[j], violations[j])
+    solution.evaluations = evaluations
+    solution.iterations = iteration
+    solution.reason = reason
+    return solution
+
+
+def repair(problem, budget=None, iterations_limit=200, neighbors=16, initial_state=None, stop_when_valid=True):
+    # moves one token at a time from the lattice placement by default, keeps
+    # improvements and halves the step after a round without any
+    deadline = None if budget is None else time.perf_counter()+budget
+    rng = generator()
+    evaluations = 1
+    if initial_state is None:
+        seed = lattice(problem)
+        initial_state = seed.state
+        evaluations += seed.evaluations
+    current = centersOf(initial_state)
+    bad, violations = problem.evaluate(current[None])
+    current_bad = bad[0]
+    solution = Solution(problem.stateOf(current), -bad[0], violations[0])
+    step = max(problem.radii)
+    improved = False
+    iteration = 0
+    while True:
+        reason = stopReason(problem, solution, iteration, iterations_limit, deadline, stop_when_valid)
+        if reason is not None:
+            break
+        token = iteration % len(current)
+        candidates = jitter(rng, current, neighbors, step, token)
+        bad, violations = problem.evaluate(candidates)
+        evaluations += neighbors
+        iteration += 1
+        j = int(np.argmin(bad))
+        if bad[j] < current_bad:
+            current, current_bad = candidates[j], bad[j]
+            solution = Solution(problem.stateOf(current), -bad[j], violations[j])
+            improved = True
+        if token == len(current)-1:
+            if not improved:
+                step = max(step/2, 1)
+            improved = False
+    solution.evaluations = evaluations
+    solution.iterations = iteration
+    solution.reason = reason
+    return solution
+
+
+def rasterize(problem, budget=None, step=2, stop_when_valid=True):
+    # the distance transform engine, tokens to avoid are taken as circles
+    if step not in raster_placers.keys():
+        raster_placers[step] = RasterPlacer(step)
+    placed = [tuple(circle) for circle in problem.avoid_circles]
+    state = raster_placers[step].place(problem.cell, problem.cell.polygon, placed, problem.radii)
+    return finish(problem, centersOf(state), 0, 1, 'placed')
+
+
+PLACEMENT_SOLVERS = {
+    'genetic': evolve,
+    'annealing': anneal,
+    'lattice': lattice,
+    'repair': repair,
+    'raster': rasterize
+}
+
+
+def solve(name, problem, budget=None, **options):
+    # all solvers score with problem.evaluate and take a budget in seconds,
+    # solver specific options are passed on
+    if name not in PLACEMENT_SOLVERS.keys():
+        raise ValueError('Unknown placement solver {0}'.format(name))
+    return PLACEMENT_SOLVERS[name](problem, budget=budget, **options)
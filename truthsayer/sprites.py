@@ -0,0 +1,63 @@
+from PIL import Image
+
+try:
+    import importlib.resources as pkg_resources
+except ImportError:
+    # Try backported to PY<37 `importlib_resources`.
+    import importlib_resources as pkg_resources
+
+from truthsayer import assets
+from truthsayer.cache import LRUCache
+
+
+def imageWeight(image):
+    width, height = image.size
+    return width*height*len(image.getbands())
+
+
+# decoded RGBA sprites keyed by asset file, size and angle, shared by all
+# renderers of the process, paste or copy them before drawing on them
+class SpriteCache:
+    def __init__(self, max_bytes=128*2**20):
+        self.images = LRUCache(max_bytes, weigh=imageWeight)
+
+    def load(self, filename):
+        def decode():
+            with pkg_resources.open_binary(assets, filename) as f:
+                image = Image.open(f)
+                image = image.convert('RGBA')
+            return image
+        return self.images.fetch((filename, None, 0), decode)
+
+    def get(self, filename, size=None, angle=0):
+        if size is None and angle == 0:
+            return self.load(filename)
+        size = None if size is None else (int(size[0]), int(size[1]))
+        key = filename, size, angle
+
+        def transform():
+            token = self.load(filename)
+            if size is not None:
+                token = token.resize(size, Image.ANTIALIAS)
+            if angle != 0:
+                token = token.rotate(angle, Image.NEAREST, expand=1)
+            return token
+        return self.images.fetch(key, transform)
+
+    def scaled(self, filename, scale, angle=0):
+        width, height = self.load(filename).size
+        size = int(scale*width), int(scale*height)
+        return self.get(filename, size, angle)
+
+    def warm(self, filenames, size=None):
+        for filename in filenames:
+            self.get(filename, size)
+
+    def clear(self):
+        self.images.clear()
+
+    def stats(self):
+        return self.images.stats()
+
+
+sprites = SpriteCache()